@@ -7,17 +7,19 @@ the acceleration relative to the number of bodies in the simulation.
 import gc
 import sys
 from itertools import product, repeat
-from multiprocessing import Pool
 from os.path import realpath
 from time import perf_counter
 
 import matplotlib.pyplot as plt
 import numpy as np
+from numba import config, set_num_threads
 
 sys.path.append(realpath(__file__ + "/../../src"))  # ensure that project files can be imported
 
 import barnes_hut
+import barnes_hut_numba
 import direct_sum
+import direct_sum_numba
 from init_cond import generate_planetary_system
 
 
@@ -35,13 +37,20 @@ def time_simulation(acc_func, num_bodies, number=10):
 
     masses, pos, _ = generate_planetary_system(num_bodies, seed=seed)
 
+    # exclude one-time costs like JIT compilation from the measurement
+    acc_func(masses, pos)
+
+    # a separate copy of the masses for every call, otherwise `barnes_hut.acceleration` would
+    # only update the quadtree cached in the previous call instead of building a new one
+    masses_copies = [masses.copy() for _ in repeat(None, number)]
+
     gc_state = gc.isenabled()
     gc.disable()
 
     try:
         start = perf_counter()
-        for _ in repeat(None, number):
-            acc_func(masses, pos)
+        for masses_copy in masses_copies:
+            acc_func(masses_copy, pos)
         end = perf_counter()
         total_time = end - start
     finally:
@@ -53,15 +62,21 @@ def time_simulation(acc_func, num_bodies, number=10):
 
 def test_acc(bodies_upper, steps=10):
     bodies = np.linspace(2, bodies_upper, num=steps, dtype=int)
-    acc_funcs = (direct_sum.acceleration, direct_sum.acceleration_vec, barnes_hut.acceleration)
-
-    with Pool() as pool:
-        result = pool.starmap_async(
-            time_simulation,
-            product(acc_funcs, bodies),
-        ).get()
-
-    for i, func in enumerate(("Direct sum", "Vec. direct sum", "Barnes-Hut")):
+    acc_funcs = (
+        direct_sum.acceleration,
+        direct_sum.acceleration_vec,
+        direct_sum_numba.acceleration,
+        barnes_hut.acceleration,
+        barnes_hut_numba.acceleration,
+    )
+
+    # the compiled kernels already use all CPU threads, so the measurements are run one
+    # after another instead of distributing them across processes competing for the CPU
+    set_num_threads(config.NUMBA_NUM_THREADS)
+    result = [time_simulation(*args) for args in product(acc_funcs, bodies)]
+
+    labels = ("Direct sum", "Vec. direct sum", "Numba direct sum", "Barnes-Hut", "Numba Barnes-Hut")
+    for i, func in enumerate(labels):
         times = result[len(bodies) * i : len(bodies) * (i + 1)]
         plt.scatter(bodies, times, label=func)
 
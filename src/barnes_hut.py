@@ -16,6 +16,11 @@ __license__ = "MIT"
 positions = np.empty(1)
 masses = np.empty(1)
 
+# quadtree cached between calls and the external quad holding each body
+tree = None
+leaves = []
+tree_margin = 0.05  # relative padding of the root quad
+
 
 class Quad:
     """
@@ -31,15 +36,17 @@ class Quad:
       --0--  --1--
     """
 
-    def __init__(self, x, y, size):
+    def __init__(self, x, y, size, parent=None):
         """
         :param x: x coordinate of the lower left corner.
         :param y: y coordinate of the lower left corner.
         :param size: Side length of the quadrant.
+        :param parent: Quad this quad is a sub-quadrant of.
         """
 
         self.x = x
         self.y = y
+        self.parent = parent
 
         # storing half the side length is convenient for calculating the position of sub-quadrants
         self.radius = size / 2
@@ -48,7 +55,9 @@ class Quad:
         self.children = [None, None, None, None]  # indexing described above
 
         # Center of mass and total mass of this quad and all of its children
-        self.center_of_mass = np.array((0.0, 0.0))
+        # stored as scalars to avoid allocating an array for every quad
+        self.cx = 0.0
+        self.cy = 0.0
         self.total_mass = 0
 
     @property
@@ -68,62 +77,112 @@ class Quad:
         :param body_idx: Index of body to be added.
         """
 
-        # internal node -> distribute new body to children
-        if self.is_internal:
-            self.get_sub_quad(body_idx).add_body(body_idx)
+        quad = self
 
-            self.center_of_mass = (
-                self.total_mass * self.center_of_mass + masses[body_idx] * positions[body_idx]
-            ) / (self.total_mass + masses[body_idx])
-            self.total_mass += masses[body_idx]
+        # walk down the tree iteratively until the body has been placed
+        while True:
 
-        # unfilled external node -> add to self
-        elif self.body is None:
-            self.body = body_idx
+            # internal node -> distribute new body to children
+            if quad.is_internal:
+                quad._add_mass(body_idx)
+                quad = quad.get_sub_quad(body_idx)
 
-            self.center_of_mass = positions[body_idx]
-            self.total_mass = masses[body_idx]
+            # unfilled external node -> add to self
+            elif quad.body is None:
+                quad.body = body_idx
+                leaves[body_idx] = quad
 
-        # filled external node -> distribute current & new body to children
-        else:
-            self.get_sub_quad(self.body).add_body(self.body)
-            self.body = None
+                quad.cx = positions[body_idx, 0]
+                quad.cy = positions[body_idx, 1]
+                quad.total_mass = masses[body_idx]
+                return
 
-            self.get_sub_quad(body_idx).add_body(body_idx)
+            # filled external node -> move current body to a new child, which is
+            # guaranteed to be empty, and continue with this now internal node
+            else:
+                # identical positions would be subdivided forever, see `build_tree`
+                # in `barnes_hut_numba`
+                if quad.radius == 0:
+                    raise ValueError("Bodies with identical positions cannot be placed in the tree")
 
-            self.center_of_mass = (
-                self.total_mass * self.center_of_mass + masses[body_idx] * positions[body_idx]
-            ) / (self.total_mass + masses[body_idx])
-            self.total_mass += masses[body_idx]
+                quad.get_sub_quad(quad.body).add_body(quad.body)
+                quad.body = None
 
-    def get_sub_quad_index(self, body_idx):
+    def remove_body(self):
+        """
+        Removes the body held by this external quad. Quads that are
+        left without any bodies are removed from the tree.
         """
-        Finds the index of the sub-quadrant in which
-        the specified body should be placed.
 
-        :param body_idx: Index of body to be placed.
-        :return: Sub-quadrant index.
+        self.body = None
+
+        quad = self
+        while quad.parent is not None and quad.body is None and not quad.is_internal:
+            siblings = quad.parent.children
+            siblings[siblings.index(quad)] = None
+            quad = quad.parent
+
+    def update_mass(self):
+        """
+        Recalculates center of mass and total mass of this quad and all of its
+        children from the current positions of the bodies.
         """
 
-        pos = positions[body_idx, :]
+        # collect quads such that children are always listed before their parent
+        quads = []
+        stack = [self]
+        while stack:
+            quad = stack.pop()
+            quads.append(quad)
+            stack.extend(child for child in quad.children if child is not None)
+
+        for quad in reversed(quads):
+            if quad.body is not None:
+                quad.cx = positions[quad.body, 0]
+                quad.cy = positions[quad.body, 1]
+                quad.total_mass = masses[quad.body]
+                continue
+
+            cx = cy = total_mass = 0.0
+            for child in quad.children:
+                if child is not None:
+                    cx += child.total_mass * child.cx
+                    cy += child.total_mass * child.cy
+                    total_mass += child.total_mass
+
+            quad.total_mass = total_mass
+            if total_mass:
+                quad.cx = cx / total_mass
+                quad.cy = cy / total_mass
+
+    def _add_mass(self, body_idx):
+        """
+        Updates center of mass and total mass of the quad with the specified body.
 
-        # right half of quad
-        if pos[0] > self.x + self.radius:
+        :param body_idx: Index of body that was added.
+        """
 
-            # upper half of quad
-            if pos[1] > self.y + self.radius:
-                return 3
+        mass = masses[body_idx]
+        new_mass = self.total_mass + mass
 
-            return 1
+        self.cx = (self.total_mass * self.cx + mass * positions[body_idx, 0]) / new_mass
+        self.cy = (self.total_mass * self.cy + mass * positions[body_idx, 1]) / new_mass
+        self.total_mass = new_mass
 
-        # left half of quad
-        else:
+    def get_sub_quad_index(self, body_idx):
+        """
+        Finds the index of the sub-quadrant in which
+        the specified body should be placed.
 
-            # upper half of quad
-            if pos[1] > self.y + self.radius:
-                return 2
+        :param body_idx: Index of body to be placed.
+        :return: Sub-quadrant index.
+        """
 
-            return 0
+        # branchless version of the indexing scheme described in the class docstring:
+        # bit 0 is set in the right half of the quad, bit 1 in the upper half
+        return int(positions[body_idx, 0] > self.x + self.radius) | (
+            int(positions[body_idx, 1] > self.y + self.radius) << 1
+        )
 
     def get_sub_quad(self, body_idx):
         """
@@ -138,61 +197,154 @@ class Quad:
 
         # create new sub-quad if it doesn't exist
         if self.children[sub_quad_idx] is None:
-            new_x = self.x + self.radius * (sub_quad_idx % 2)
-            new_y = self.y + self.radius * (1 if sub_quad_idx >= 2 else 0)
+            new_x = self.x + self.radius * (sub_quad_idx & 1)
+            new_y = self.y + self.radius * (sub_quad_idx >> 1)
 
-            self.children[sub_quad_idx] = Quad(new_x, new_y, self.radius)
+            self.children[sub_quad_idx] = Quad(new_x, new_y, self.radius, self)
 
         return self.children[sub_quad_idx]
 
 
-def _calculate_acceleration(quad, body_idx, theta):
+def _calculate_acceleration(root, theta, result):
     """
-    Internal function used to calculate the acceleration of a particular body
-    caused by the specified quadrant in both x & y direction based on the
+    Internal function used to calculate the acceleration of all bodies caused
+    by the specified quadrant in both x & y direction based on the
     gravitational force using the Barnes-Hut algorithm.
 
-    :param quad: Acceleration is calculated based on the
+    Instead of traversing the quadtree separately for each body, all bodies
+    traverse it as a batch. At each quad, the batch is split into bodies for
+    which the quad can be approximated and bodies which have to descend
+    further into the tree. This way, the work at each quad is vectorized.
+
+    :param root: Acceleration is calculated based on the
                  bodies contain within this quadrant.
-    :param body_idx: Index of the body of which the
-                     acceleration will be calculated.
     :param theta: See `acceleration` function below.
-    :return: A (2,) array containing the acceleration on the specified body.
+    :param result: A (N, 2) array the accelerations are written to.
+    :return: A (N, 2) array of accelerations.
     """
 
-    dist = quad.center_of_mass - positions[body_idx]
-    norm_sq = dist.dot(dist)
+    pos_x = np.ascontiguousarray(positions[:, 0])
+    pos_y = np.ascontiguousarray(positions[:, 1])
+    theta_sq = theta ** 2
+
+    result.fill(0.0)
+
+    # traverse quadtree iteratively using an explicit stack of quads
+    # and the indices of the bodies that still have to visit them
+    stack = [(root, np.arange(len(masses)))]
+    while stack:
+        quad, body_indices = stack.pop()
+
+        dx = quad.cx - pos_x[body_indices]
+        dy = quad.cy - pos_y[body_indices]
+        norm_sq = dx * dx + dy * dy
+
+        # quad is sufficiently far away -> approximate
+        # equivalent to s/L < theta
+        far = 4 * quad.radius ** 2 < theta_sq * norm_sq
+        if far.any():
+            factor = quad.total_mass / (norm_sq[far] * np.sqrt(norm_sq[far]))
+            result[body_indices[far], 0] += factor * dx[far]
+            result[body_indices[far], 1] += factor * dy[far]
+
+        near = ~far
+        if not near.any():
+            continue
+
+        # internal quad too close -> sum acceleration of children
+        if quad.is_internal:
+            near_indices = body_indices[near]
+            stack.extend((child, near_indices) for child in quad.children if child is not None)
+
+        # different external quad -> calculate acceleration directly
+        # same external quad -> no acceleration
+        else:
+            near &= body_indices != quad.body
+            factor = masses[quad.body] / (norm_sq[near] * np.sqrt(norm_sq[near]))
+            result[body_indices[near], 0] += factor * dx[near]
+            result[body_indices[near], 1] += factor * dy[near]
+
+    return result
+
+
+def _build_tree():
+    """
+    Internal function used to build a new quadtree that contains all bodies.
+    """
+
+    global tree, leaves
+
+    maxs = positions.max(axis=0)  # max values in x & y direction
+    mins = positions.min(axis=0)  # min values in x & y direction
+
+    # leave some room for bodies to move before the quadtree has to be rebuilt
+    root_size = (1 + tree_margin) * np.max(maxs - mins)
+    root_pos = 0.5 * (maxs + mins - root_size)
+    tree = Quad(root_pos[0], root_pos[1], root_size)
 
-    # quad is sufficiently far away -> approximate
-    # equivalent to s/L < theta
-    if 4 * quad.radius ** 2 < theta ** 2 * norm_sq:
-        return quad.total_mass * dist * norm_sq ** -1.5
+    # fill quadtree
+    leaves = [None] * len(masses)
+    try:
+        for body_idx in range(len(masses)):
+            tree.add_body(body_idx)
+    except BaseException:
+        # discard the partially built quadtree such that the next call does not reuse it
+        tree = None
+        leaves = []
+        raise
+
+
+def _update_tree():
+    """
+    Internal function used to update the cached quadtree to the current
+    positions of the bodies. Over a small time step, most bodies remain in the
+    external quad they were placed in, so only the bodies that left their quad
+    are removed and inserted again. The centers of mass are then updated in a
+    single pass over the tree.
+
+    :return: Whether the quadtree could be updated. If not, it has to be rebuilt.
+    """
+
+    pos_x = positions[:, 0]
+    pos_y = positions[:, 1]
+
+    # bodies outside of the root quad cannot be inserted
+    if (
+        pos_x.min() < tree.x
+        or pos_y.min() < tree.y
+        or pos_x.max() > tree.x + tree.size
+        or pos_y.max() > tree.y + tree.size
+    ):
+        return False
 
-    # internal quad too close -> sum acceleration of children
-    elif quad.is_internal:
-        acc = np.zeros(2)
+    leaf_x, leaf_y, leaf_size = np.array([(leaf.x, leaf.y, leaf.size) for leaf in leaves]).T
+    outside_x = (pos_x < leaf_x) | (pos_x > leaf_x + leaf_size)
+    outside_y = (pos_y < leaf_y) | (pos_y > leaf_y + leaf_size)
+    moved = np.flatnonzero(outside_x | outside_y)
 
-        for child in quad.children:
-            if child is not None:
-                acc += _calculate_acceleration(child, body_idx, theta)
+    # rebuilding is cheaper if most bodies have to be moved anyway
+    if 2 * len(moved) > len(masses):
+        return False
 
-        return acc
+    for body_idx in moved:
+        leaves[body_idx].remove_body()
 
-    # different external quad -> calculate acceleration directly
-    elif quad.body != body_idx:
-        return masses[quad.body] * dist * norm_sq ** -1.5
+    for body_idx in moved:
+        tree.add_body(body_idx)
 
-    # same external quad -> no acceleration
-    else:
-        return np.zeros(2)
+    tree.update_mass()
 
+    return True
 
-def acceleration(m, current_pos, theta=0.5):
+
+def acceleration(m, current_pos, theta=0.5, out=None):
     """
     Calculates the acceleration for each body in both x & y direction based on
     the gravitational force using the Barnes-Hut algorithm. For this, it builds
     a quadtree that contains all bodies and then calculates the acceleration
-    for each body separately based on the quadtree.
+    for all bodies based on the quadtree. If called again with the same masses,
+    e.g. in consecutive time steps of an integrator, the quadtree is updated
+    instead of being rebuilt from scratch.
 
     :param m: A (N,) array of masses.
     :param current_pos: A (N, 2) array of current positions of all bodies.
@@ -203,6 +355,7 @@ def acceleration(m, current_pos, theta=0.5):
                   level. If theta is equal to 0, the scheme is equivalent to a
                   direct sum approach as no internal quad will be approximated
                   as a single body.
+    :param out: Optional (N, 2) array the accelerations are written to.
     :return: A (N, 2) array of accelerations.
     """
 
@@ -211,23 +364,16 @@ def acceleration(m, current_pos, theta=0.5):
     # bodies it is interacting with. Alternatively, each Quad instance could store
     # a copy of the positions but this would be more computationally expensive.
     global positions, masses
+    same_bodies = m is masses and len(leaves) == len(m)
     positions = current_pos
     masses = m
 
-    # build quadtree
-    maxs = current_pos.max(axis=0)  # max values in x & y direction
-    mins = current_pos.min(axis=0)  # min values in x & y direction
-    root_size = np.max(maxs - mins)
-    root_pos = 0.5 * (maxs + mins - root_size)
-    root = Quad(root_pos[0], root_pos[1], root_size)
+    # reuse the quadtree of the previous call if possible, otherwise build a new one
+    if not (same_bodies and _update_tree()):
+        _build_tree()
 
-    # fill quadtree
-    for body_idx in range(len(m)):
-        root.add_body(body_idx)
+    if out is None:
+        out = np.empty((len(m), 2))
 
     # calculate acceleration for all bodies
-    result = np.zeros_like(current_pos)
-    for body_idx in range(len(m)):
-        result[body_idx] = _calculate_acceleration(root, body_idx, theta)
-
-    return result
+    return _calculate_acceleration(tree, theta, out)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""n-body-sim: src/barnes_hut_numba
+Implementation of the Barnes-Hut algorithm for calculating the acceleration
+caused by the gravitational force, compiled to machine code using Numba.
+
+Instead of a tree of Python objects, the quadtree is stored as a flat set of
+arrays indexed by node. Node 0 is the root. The sub-quadrant children of a
+node follow the same indexing scheme as the `Quad` class in `barnes_hut`.
+"""
+import numpy as np
+from numba import njit, prange
+
+
+__author__ = "jeypiti"
+__copyright__ = "Copyright 2022, jeypiti"
+__credits__ = ["jeypiti"]
+__license__ = "MIT"
+
+
+# special values of the node body array
+EMPTY = -1  # external node that holds no body
+INTERNAL = -2  # internal node, i.e. a node with children
+
+
+@njit(cache=True)
+def _grow(arr):
+    """
+    Internal function used to double the capacity of a node array.
+
+    :param arr: Node array whose first axis will be doubled in size.
+    :return: Copy of the node array with twice the capacity.
+    """
+
+    new_arr = np.empty((2 * arr.shape[0],) + arr.shape[1:], dtype=arr.dtype)
+    new_arr[: arr.shape[0]] = arr
+    return new_arr
+
+
+@njit(cache=True)
+def build_tree(masses, pos_x, pos_y):
+    """
+    Builds a quadtree that contains all bodies.
+
+    :param masses: A (N,) array of masses.
+    :param pos_x: A (N,) array of x coordinates.
+    :param pos_y: A (N,) array of y coordinates.
+    :return: Tuple of the number of nodes and the node arrays holding the
+             lower left corner (x, y), half the side length, the center of
+             mass (x, y), the total mass, the body index, and the (M, 4)
+             children indices of each node.
+    """
+
+    capacity = 4 * len(masses) + 1
+
+    node_x = np.empty(capacity)
+    node_y = np.empty(capacity)
+    node_radius = np.empty(capacity)
+    node_cm_x = np.empty(capacity)
+    node_cm_y = np.empty(capacity)
+    node_mass = np.empty(capacity)
+    node_body = np.empty(capacity, dtype=np.int64)
+    node_child = np.empty((capacity, 4), dtype=np.int64)
+
+    # set up root quad
+    x_min, x_max = pos_x.min(), pos_x.max()
+    y_min, y_max = pos_y.min(), pos_y.max()
+    root_size = max(x_max - x_min, y_max - y_min)
+
+    node_x[0] = 0.5 * (x_max + x_min - root_size)
+    node_y[0] = 0.5 * (y_max + y_min - root_size)
+    node_radius[0] = root_size / 2
+    node_mass[0] = 0.0
+    node_body[0] = EMPTY
+    node_child[0, :] = -1
+    node_count = 1
+
+    for body_idx in range(len(masses)):
+        node = 0
+
+        # walk down the tree until the body has been placed in an external node
+        while True:
+            body = node_body[node]
+
+            # unfilled external node -> add to self
+            if body == EMPTY:
+                node_body[node] = body_idx
+                node_cm_x[node] = pos_x[body_idx]
+                node_cm_y[node] = pos_y[body_idx]
+                node_mass[node] = masses[body_idx]
+                break
+
+            # filled external node -> move current body to a new child and
+            # continue with this node, which is now internal
+            if body != INTERNAL:
+                if node_radius[node] == 0:
+                    raise ValueError("Bodies with identical positions cannot be placed in the tree")
+
+                node_body[node] = INTERNAL
+                body_to_place = body
+            else:
+                # internal node -> update center of mass and descend
+                old_mass = node_mass[node]
+                new_mass = old_mass + masses[body_idx]
+                node_cm_x[node] = (
+                    old_mass * node_cm_x[node] + masses[body_idx] * pos_x[body_idx]
+                ) / new_mass
+                node_cm_y[node] = (
+                    old_mass * node_cm_y[node] + masses[body_idx] * pos_y[body_idx]
+                ) / new_mass
+                node_mass[node] = new_mass
+                body_to_place = body_idx
+
+            # branchless sub-quadrant index, see `Quad` class in `barnes_hut`
+            radius = node_radius[node]
+            sub_quad_idx = int(pos_x[body_to_place] > node_x[node] + radius) | (
+                int(pos_y[body_to_place] > node_y[node] + radius) << 1
+            )
+
+            child = node_child[node, sub_quad_idx]
+
+            # create new sub-quad if it doesn't exist
+            if child == -1:
+                if node_count == len(node_x):
+                    node_x = _grow(node_x)
+                    node_y = _grow(node_y)
+                    node_radius = _grow(node_radius)
+                    node_cm_x = _grow(node_cm_x)
+                    node_cm_y = _grow(node_cm_y)
+                    node_mass = _grow(node_mass)
+                    node_body = _grow(node_body)
+                    node_child = _grow(node_child)
+
+                child = node_count
+                node_count += 1
+
+                node_x[child] = node_x[node] + radius * (sub_quad_idx & 1)
+                node_y[child] = node_y[node] + radius * (sub_quad_idx >> 1)
+                node_radius[child] = radius / 2
+                node_mass[child] = 0.0
+                node_body[child] = EMPTY
+                node_child[child, :] = -1
+                node_child[node, sub_quad_idx] = child
+
+            # the new body still has to be distributed to this node's children
+            if body_to_place == body_idx:
+                node = child
+            else:
+                node_body[child] = body_to_place
+                node_cm_x[child] = pos_x[body_to_place]
+                node_cm_y[child] = pos_y[body_to_place]
+                node_mass[child] = masses[body_to_place]
+
+    return (
+        node_count,
+        node_x,
+        node_y,
+        node_radius,
+        node_cm_x,
+        node_cm_y,
+        node_mass,
+        node_body,
+        node_child,
+    )
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _acceleration_kernel(
+    pos_x,
+    pos_y,
+    theta,
+    node_count,
+    node_radius,
+    node_cm_x,
+    node_cm_y,
+    node_mass,
+    node_body,
+    node_child,
+    result,
+):
+    """
+    Internal kernel used to calculate the acceleration for each body by
+    traversing the quadtree with an explicit stack instead of recursion.
+    The loop over the bodies is distributed across all CPU threads.
+
+    :param pos_x: A (N,) array of x coordinates.
+    :param pos_y: A (N,) array of y coordinates.
+    :param theta: See `acceleration` function below.
+    :param node_count: Number of nodes in the quadtree.
+    :param result: A (N, 2) array the accelerations are written to.
+    :return: A (N, 2) array of accelerations.
+
+    The remaining parameters are the node arrays returned by `build_tree`.
+    """
+
+    theta_sq = theta * theta
+
+    for body_idx in prange(len(pos_x)):
+        stack = np.empty(node_count, dtype=np.int64)
+        stack[0] = 0
+        stack_size = 1
+
+        ax = 0.0
+        ay = 0.0
+
+        while stack_size > 0:
+            stack_size -= 1
+            node = stack[stack_size]
+
+            dx = node_cm_x[node] - pos_x[body_idx]
+            dy = node_cm_y[node] - pos_y[body_idx]
+            norm_sq = dx * dx + dy * dy
+
+            # quad is sufficiently far away -> approximate
+            # equivalent to s/L < theta
+            if 4 * node_radius[node] ** 2 < theta_sq * norm_sq:
+                factor = node_mass[node] / (norm_sq * np.sqrt(norm_sq))
+                ax += factor * dx
+                ay += factor * dy
+
+            # internal quad too close -> traverse children
+            elif node_body[node] == INTERNAL:
+                for sub_quad_idx in range(4):
+                    child = node_child[node, sub_quad_idx]
+                    if child != -1:
+                        stack[stack_size] = child
+                        stack_size += 1
+
+            # different external quad -> calculate acceleration directly
+            elif node_body[node] != body_idx and node_body[node] != EMPTY:
+                factor = node_mass[node] / (norm_sq * np.sqrt(norm_sq))
+                ax += factor * dx
+                ay += factor * dy
+
+        result[body_idx, 0] = ax
+        result[body_idx, 1] = ay
+
+    return result
+
+
+@njit(cache=True)
+def acceleration(m, current_pos, theta=0.5, out=None):
+    """
+    Calculates the acceleration for each body in both x & y direction based on
+    the gravitational force using a compiled version of the Barnes-Hut algorithm.
+
+    :param m: A (N,) array of masses.
+    :param current_pos: A (N, 2) array of current positions of all bodies.
+    :param theta: Threshold value used by the Barnes-Hut algorithm to determine
+                  if a quad is sufficiently far away or sufficiently close to a
+                  reference body. See `acceleration` function in `barnes_hut`.
+    :param out: Optional (N, 2) array the accelerations are written to.
+    :return: A (N, 2) array of accelerations.
+    """
+
+    if out is None:
+        out = np.empty((len(m), 2))
+
+    pos_x = current_pos[:, 0].copy()
+    pos_y = current_pos[:, 1].copy()
+
+    (
+        node_count,
+        _,
+        _,
+        node_radius,
+        node_cm_x,
+        node_cm_y,
+        node_mass,
+        node_body,
+        node_child,
+    ) = build_tree(m, pos_x, pos_y)
+
+    return _acceleration_kernel(
+        pos_x,
+        pos_y,
+        theta,
+        node_count,
+        node_radius,
+        node_cm_x,
+        node_cm_y,
+        node_mass,
+        node_body,
+        node_child,
+        out,
+    )
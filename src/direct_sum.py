@@ -13,28 +13,44 @@ __credits__ = ["jeypiti"]
 __license__ = "MIT"
 
 
-def acceleration(masses, current_pos):
+# scratch buffers used by `acceleration_vec`, keyed by the block size and type
+_scratch = {}
+
+
+def acceleration(masses, current_pos, out=None):
     """
     Calculates the acceleration for each body in both x & y direction
     based on the gravitational force using the direct sum approach.
 
     :param masses: A (N,) array of masses.
     :param current_pos: A (N, 2) array of current positions of all bodies.
+    :param out: Optional (N, 2) array the accelerations are written to.
     :return: A (N, 2) array of accelerations.
     """
 
-    result = np.zeros((len(masses), 2))
+    if out is None:
+        result = np.zeros((len(masses), 2))
+    else:
+        result = out
+        result.fill(0.0)
 
+    # only consider each pair once and apply Newton's third law to the second body
     for m1 in range(len(masses)):
-        for m2 in range(len(masses)):
-            if m1 != m2:
-                dist = current_pos[m1, :] - current_pos[m2, :]
-                result[m1, :] -= masses[m2] * dist * dist.dot(dist) ** -1.5
+        for m2 in range(m1 + 1, len(masses)):
+            # scalar arithmetic avoids the overhead of NumPy calls on length-2 arrays
+            dx = current_pos[m1, 0] - current_pos[m2, 0]
+            dy = current_pos[m1, 1] - current_pos[m2, 1]
+            inv_r3 = (dx * dx + dy * dy) ** -1.5
+
+            result[m1, 0] -= masses[m2] * dx * inv_r3
+            result[m1, 1] -= masses[m2] * dy * inv_r3
+            result[m2, 0] += masses[m1] * dx * inv_r3
+            result[m2, 1] += masses[m1] * dy * inv_r3
 
     return result
 
 
-def acceleration_vec(masses, current_pos):
+def acceleration_vec(masses, current_pos, dtype=np.float64, block_size=256, out=None, pot_out=None):
     """
     Calculates the acceleration for each body in both x & y direction based
     on the gravitational force using a vectorized direct sum approach.
@@ -42,8 +58,114 @@ def acceleration_vec(masses, current_pos):
     Implementation inspired by Philip Mocz:
     https://github.com/pmocz/nbody-python
 
+    If there are more than block_size bodies, the pairwise interactions are
+    calculated in blocks of at most block_size x block_size body pairs such
+    that the intermediate matrices stay in the CPU cache instead of going
+    through main memory.
+
+    Bodies at the same position do not interact with each other instead
+    of producing infinite accelerations.
+
+    The gravitational potential energy of the system can be calculated
+    alongside the accelerations from the same pairwise distances, which
+    allows integrators to track the energy without a separate pass.
+
     :param masses: A (N,) array of masses.
     :param current_pos: A (N, 2) array of current positions of all bodies.
+    :param dtype: Floating point type used for the pairwise calculations. Using
+                  np.float32 halves the memory traffic at the cost of precision.
+                  The result is returned as np.float64 unless out is given, in
+                  which case it takes the type of out.
+    :param block_size: Maximum number of bodies per block.
+    :param out: Optional (N, 2) array the accelerations are written to.
+    :param pot_out: Optional (1,) array the potential energy is written to.
+    :return: A (N, 2) array of accelerations.
+    """
+
+    n = len(masses)
+    masses = masses.astype(dtype, copy=False)
+    current_pos = current_pos.astype(dtype, copy=False)
+
+    if n <= block_size:
+        return _acceleration_single_block(masses, current_pos, out, pot_out)
+
+    # reuse scratch buffers between calls with the same block size and type
+    key = (block_size, np.dtype(dtype))
+    if key not in _scratch:
+        _scratch[key] = tuple(np.empty((block_size, block_size), dtype=dtype) for _ in range(4))
+    dx_buf, dy_buf, r2_buf, factor_buf = _scratch[key]
+
+    # extract x & y coordinates to a (N, 1) array and the transposed (1, N) array
+    x = current_pos[:, 0:1]
+    y = current_pos[:, 1:2]
+    x_t = x.T
+    y_t = y.T
+
+    result = np.zeros((n, 2)) if out is None else out
+    result.fill(0.0)
+
+    if pot_out is not None:
+        pot_out.fill(0.0)
+
+    # block i contains the bodies whose acceleration is calculated,
+    # block j contains the bodies that cause the acceleration
+    for i_start in range(0, n, block_size):
+        i_end = min(i_start + block_size, n)
+
+        for j_start in range(0, n, block_size):
+            j_end = min(j_start + block_size, n)
+
+            # views of the scratch buffers matching the size of the current block
+            dx = dx_buf[: i_end - i_start, : j_end - j_start]
+            dy = dy_buf[: i_end - i_start, : j_end - j_start]
+            r2 = r2_buf[: i_end - i_start, : j_end - j_start]
+            factor = factor_buf[: i_end - i_start, : j_end - j_start]
+
+            # matrices that store pairwise body distances
+            np.subtract(x_t[:, j_start:j_end], x[i_start:i_end], out=dx)
+            np.subtract(y_t[:, j_start:j_end], y[i_start:i_end], out=dy)
+
+            # squared distances, factor is used as a temporary buffer
+            np.multiply(dx, dx, out=r2)
+            r2 += np.multiply(dy, dy, out=factor)
+
+            # calculate r^-3 factor as 1 / (r^2 * sqrt(r^2)) which is much cheaper than a generic
+            # power, replacing vanishing distances by infinite ones makes the factor vanish for
+            # the self-interaction on the diagonal as well as for distinct bodies at the same
+            # position, which are ignored instead of producing infinite accelerations
+            zero = r2 == 0
+            np.copyto(r2, np.inf, where=zero)
+            np.sqrt(r2, out=factor)
+            factor *= r2
+            np.reciprocal(factor, out=factor)
+
+            if pot_out is not None:
+                # r^-1 = r^2 * r^-3, the infinite distances are replaced by zero beforehand
+                # such that they vanish instead of becoming 0 * inf = nan
+                np.copyto(r2, 0.0, where=zero)
+                inv_r = np.multiply(factor, r2, out=r2)
+                pot_out -= 0.5 * (inv_r @ masses[j_start:j_end]) @ masses[i_start:i_end]
+
+            # calculate acceleration in x & y direction, multiplying in place avoids temporary
+            # matrices and lets the reduction run as a BLAS matrix-vector product, which is
+            # considerably faster than fusing both steps with np.einsum
+            result[i_start:i_end, 0] += np.multiply(dx, factor, out=dx) @ masses[j_start:j_end]
+            result[i_start:i_end, 1] += np.multiply(dy, factor, out=dy) @ masses[j_start:j_end]
+
+    return result
+
+
+def _acceleration_single_block(masses, current_pos, out, pot_out):
+    """
+    Internal function used to calculate the accelerations if all bodies fit
+    into a single block, see `acceleration_vec` function above. All pairwise
+    interactions are calculated in one pass, which avoids the overhead of the
+    block bookkeeping for few bodies.
+
+    :param masses: A (N,) array of masses.
+    :param current_pos: A (N, 2) array of current positions of all bodies.
+    :param out: Optional (N, 2) array the accelerations are written to.
+    :param pot_out: Optional (1,) array the potential energy is written to.
     :return: A (N, 2) array of accelerations.
     """
 
@@ -55,14 +177,65 @@ def acceleration_vec(masses, current_pos):
     dx = x.T - x
     dy = y.T - y
 
-    # calculate r^-3 factor
-    # mask exponentiation to avoid division by zero
-    factor = dx ** 2 + dy ** 2
-    np.float_power(factor, -1.5, where=factor != 0, out=factor)
+    # calculate r^-3 factor, vanishing distances are masked, see `acceleration_vec` function above
+    r2 = dx * dx
+    r2 += dy * dy
+    zero = r2 == 0
+    np.copyto(r2, np.inf, where=zero)
+    factor = np.sqrt(r2)
+    factor *= r2
+    np.reciprocal(factor, out=factor)
+
+    if pot_out is not None:
+        np.copyto(r2, 0.0, where=zero)
+        pot_out[:] = -0.5 * (np.multiply(factor, r2, out=r2) @ masses) @ masses
 
     # calculate acceleration in x & y direction
-    a_x = (dx * factor) @ masses
-    a_y = (dy * factor) @ masses
+    result = np.empty((len(masses), 2)) if out is None else out
+    result[:, 0] = np.multiply(dx, factor, out=dx) @ masses
+    result[:, 1] = np.multiply(dy, factor, out=dy) @ masses
+
+    return result
 
-    # pack a_x and a_y into desired data structure
-    return np.vstack((a_x, a_y)).T
+
+def acceleration_vec_batched(masses, current_pos, dtype=np.float64, out=None):
+    """
+    Calculates the acceleration for each body in both x & y direction for
+    several configurations of the same bodies at once, see `acceleration_vec`
+    function above. All configurations are processed in the same array
+    operations, which amortizes the overhead of each NumPy call across the
+    whole batch. Intended for integrators that evaluate several sub steps at
+    once, e.g. `pefrl_predictor` in `integrators`.
+
+    :param masses: A (N,) array of masses.
+    :param current_pos: A (B, N, 2) array of B sets of positions.
+    :param dtype: See `acceleration_vec` function above.
+    :param out: Optional (B, N, 2) array the accelerations are written to.
+    :return: A (B, N, 2) array of accelerations.
+    """
+
+    masses = masses.astype(dtype, copy=False)
+    current_pos = current_pos.astype(dtype, copy=False)
+
+    # extract x & y coordinates to a (B, N, 1) array
+    x = current_pos[:, :, 0:1]
+    y = current_pos[:, :, 1:2]
+
+    # matrices that store pairwise body distances
+    dx = x.transpose(0, 2, 1) - x
+    dy = y.transpose(0, 2, 1) - y
+
+    # calculate r^-3 factor, vanishing distances are masked, see `acceleration_vec` function above
+    r2 = dx * dx
+    r2 += dy * dy
+    r2[r2 == 0] = np.inf
+    factor = np.sqrt(r2)
+    factor *= r2
+    np.reciprocal(factor, out=factor)
+
+    # calculate acceleration in x & y direction
+    result = np.empty(current_pos.shape) if out is None else out
+    result[:, :, 0] = (dx * factor) @ masses
+    result[:, :, 1] = (dy * factor) @ masses
+
+    return result
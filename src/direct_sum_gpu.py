@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""n-body-sim: src/direct_sum_gpu
+Implementation of the direct sum method of calculating the acceleration
+caused by the gravitational force on CUDA GPUs using Numba.
+"""
+import math
+
+import numpy as np
+from numba import cuda, float32
+
+
+__author__ = "jeypiti"
+__copyright__ = "Copyright 2022, jeypiti"
+__credits__ = ["jeypiti"]
+__license__ = "MIT"
+
+
+# number of threads per block, also the number of bodies per tile in shared memory
+threads_per_block = 256
+
+
+@cuda.jit
+def _acceleration_kernel(masses, pos_x, pos_y, acc_x, acc_y):
+    """
+    Internal kernel used to calculate the acceleration for each body. Each
+    thread calculates the acceleration of one body. The bodies causing the
+    acceleration are processed in tiles which the threads of a block
+    cooperatively load into shared memory.
+
+    :param masses: A (N,) device array of masses.
+    :param pos_x: A (N,) device array of x coordinates.
+    :param pos_y: A (N,) device array of y coordinates.
+    :param acc_x: A (N,) device array the acceleration in x direction is written to.
+    :param acc_y: A (N,) device array the acceleration in y direction is written to.
+    """
+
+    tile_m = cuda.shared.array(threads_per_block, float32)
+    tile_x = cuda.shared.array(threads_per_block, float32)
+    tile_y = cuda.shared.array(threads_per_block, float32)
+
+    n = masses.shape[0]
+    i = cuda.grid(1)
+    tx = cuda.threadIdx.x
+
+    # threads beyond the last body still have to help loading the tiles
+    x_i = pos_x[i] if i < n else float32(0)
+    y_i = pos_y[i] if i < n else float32(0)
+    acc_x_i = float32(0)
+    acc_y_i = float32(0)
+
+    for tile_start in range(0, n, threads_per_block):
+        # load tile into shared memory, padding with massless bodies
+        j = tile_start + tx
+        if j < n:
+            tile_m[tx] = masses[j]
+            tile_x[tx] = pos_x[j]
+            tile_y[tx] = pos_y[j]
+        else:
+            tile_m[tx] = float32(0)
+            tile_x[tx] = float32(0)
+            tile_y[tx] = float32(0)
+        cuda.syncthreads()
+
+        for k in range(threads_per_block):
+            dx = x_i - tile_x[k]
+            dy = y_i - tile_y[k]
+            r2 = dx * dx + dy * dy
+
+            # a vanishing distance means the body interacts with itself
+            if r2 > float32(0):
+                inv_r = float32(1) / math.sqrt(r2)
+                inv_r3 = inv_r * inv_r * inv_r
+                acc_x_i -= tile_m[k] * dx * inv_r3
+                acc_y_i -= tile_m[k] * dy * inv_r3
+
+        # wait for all threads before the tile is overwritten
+        cuda.syncthreads()
+
+    if i < n:
+        acc_x[i] = acc_x_i
+        acc_y[i] = acc_y_i
+
+
+def acceleration(masses, current_pos, out=None):
+    """
+    Calculates the acceleration for each body in both x & y direction based
+    on the gravitational force using a direct sum approach on the GPU. The
+    calculation is done in single precision.
+
+    :param masses: A (N,) array of masses.
+    :param current_pos: A (N, 2) array of current positions of all bodies.
+    :param out: Optional (N, 2) array the accelerations are written to.
+    :return: A (N, 2) array of accelerations.
+    """
+
+    n = len(masses)
+
+    # copy masses and contiguous x & y coordinates to the device
+    d_masses = cuda.to_device(np.ascontiguousarray(masses, dtype=np.float32))
+    d_pos_x = cuda.to_device(np.ascontiguousarray(current_pos[:, 0], dtype=np.float32))
+    d_pos_y = cuda.to_device(np.ascontiguousarray(current_pos[:, 1], dtype=np.float32))
+    d_acc_x = cuda.device_array(n, dtype=np.float32)
+    d_acc_y = cuda.device_array(n, dtype=np.float32)
+
+    blocks = (n + threads_per_block - 1) // threads_per_block
+    _acceleration_kernel[blocks, threads_per_block](d_masses, d_pos_x, d_pos_y, d_acc_x, d_acc_y)
+
+    result = np.empty((n, 2)) if out is None else out
+    result[:, 0] = d_acc_x.copy_to_host()
+    result[:, 1] = d_acc_y.copy_to_host()
+
+    return result
+
+
+@cuda.jit
+def _potential_energy_kernel(masses, pos, pot_energy):
+    """
+    Internal kernel used to calculate the potential energy for each time
+    step. Each thread calculates the potential energy of one time step,
+    considering each pair of bodies only once.
+
+    :param masses: A (N,) device array of masses.
+    :param pos: A (T, N, 2) device array of positions over time.
+    :param pot_energy: A (T,) device array the potential energy is written to.
+    """
+
+    time_steps, n = pos.shape[:2]
+    t = cuda.grid(1)
+    if t >= time_steps:
+        return
+
+    pot = float32(0)
+    for i in range(n - 1):
+        x_i = pos[t, i, 0]
+        y_i = pos[t, i, 1]
+
+        pot_i = float32(0)
+        for j in range(i + 1, n):
+            dx = x_i - pos[t, j, 0]
+            dy = y_i - pos[t, j, 1]
+            pot_i += masses[j] / math.sqrt(dx * dx + dy * dy)
+
+        pot -= masses[i] * pot_i
+
+    pot_energy[t] = pot
+
+
+def energy(masses, pos, vel):
+    """
+    Calculates kinetic energy, gravitational potential energy, and total
+    energy for the whole system for each time step in the simulation, see
+    `calculate_energy` in `utils`. The potential energy is calculated on the
+    GPU in single precision, the kinetic energy is calculated on the CPU.
+
+    :param masses: A (N,) array of masses.
+    :param pos: A (T, N, 2) array of positions over time.
+    :param vel: A (T, N, 2) array of velocities over time.
+    :return: Tuple of kinetic energy over time, potential
+             energy over time, and total energy over time.
+    """
+
+    time_steps = pos.shape[0]
+
+    # copy masses and the whole time evolution of the positions to the device at once
+    d_masses = cuda.to_device(np.ascontiguousarray(masses, dtype=np.float32))
+    d_pos = cuda.to_device(np.ascontiguousarray(pos, dtype=np.float32))
+    d_pot_energy = cuda.device_array(time_steps, dtype=np.float32)
+
+    blocks = (time_steps + threads_per_block - 1) // threads_per_block
+    _potential_energy_kernel[blocks, threads_per_block](d_masses, d_pos, d_pot_energy)
+
+    kin_energy = 0.5 * np.einsum("n,tnd,tnd->t", masses, vel, vel, dtype=np.float64)
+    pot_energy = d_pot_energy.copy_to_host().astype(np.float64)
+
+    return kin_energy, pot_energy, kin_energy + pot_energy
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+"""n-body-sim: src/direct_sum_numba
+Implementation of the direct sum method of calculating the acceleration
+caused by the gravitational force, compiled to machine code using Numba.
+"""
+import numpy as np
+from numba import get_num_threads, njit, prange
+
+
+__author__ = "jeypiti"
+__copyright__ = "Copyright 2022, jeypiti"
+__credits__ = ["jeypiti"]
+__license__ = "MIT"
+
+
+# number of buffers the pairwise interactions are accumulated into, one per thread
+# querying the number of threads also launches Numba's thread pool, which has to
+# happen before compiled functions calling parallel kernels are loaded from the cache
+num_chunks = get_num_threads()
+
+# below this number of bodies, starting the threads costs more than the actual calculation
+parallel_threshold = 128
+
+# largest number of bodies for which `energy` uses a kernel with the loops unrolled
+max_unrolled_bodies = 8
+
+# generated energy kernels cannot be cached on disk and take seconds to compile in every
+# process, which only pays off over the general kernel for this many time steps
+min_unrolled_time_steps = 50_000_000
+
+# energy kernels generated by `_build_energy_kernel`, keyed by the number of bodies
+_energy_kernels = {}
+
+
+@njit(inline="always", fastmath=True, error_model="numpy")
+def _row_interactions(i, masses, pos_x, pos_y, acc_x, acc_y):
+    """
+    Internal function used to calculate the interactions of body i with all
+    bodies j > i. The contributions to the bodies j are added to the
+    acceleration arrays, following Newton's third law, while the contribution
+    to body i is accumulated in registers and returned. The loop contains no
+    branches so that it is compiled to SIMD instructions, e.g. vectorized
+    square roots.
+
+    :param i: Index of the body whose interactions are calculated.
+    :param masses: A contiguous (N,) array of masses.
+    :param pos_x: A contiguous (N,) array of x coordinates.
+    :param pos_y: A contiguous (N,) array of y coordinates.
+    :param acc_x: A (N,) array the acceleration in x direction is added to.
+    :param acc_y: A (N,) array the acceleration in y direction is added to.
+    :return: Tuple of the acceleration on body i in x & y direction.
+    """
+
+    x_i = pos_x[i]
+    y_i = pos_y[i]
+    m_i = masses[i]
+
+    acc_x_i = 0.0
+    acc_y_i = 0.0
+
+    # looping over an offset starting at zero, rather than over range(i + 1, N),
+    # allows the compiler to prove that j is never negative and vectorize the loop
+    for offset in range(len(masses) - i - 1):
+        j = i + 1 + offset
+
+        dx = x_i - pos_x[j]
+        dy = y_i - pos_y[j]
+        r2 = dx * dx + dy * dy
+        inv_r = 1.0 / np.sqrt(r2)
+        inv_r3 = inv_r * inv_r * inv_r
+
+        acc_x_i -= masses[j] * dx * inv_r3
+        acc_y_i -= masses[j] * dy * inv_r3
+        acc_x[j] += m_i * dx * inv_r3
+        acc_y[j] += m_i * dy * inv_r3
+
+    return acc_x_i, acc_y_i
+
+
+@njit(cache=True, fastmath=True, error_model="numpy")
+def _chunk_interactions(chunk, n_chunks, masses, pos_x, pos_y, acc_x, acc_y):
+    """
+    Internal function used to calculate the interactions of every
+    `n_chunks`-th body, starting at body `chunk`, with all following bodies.
+    Bodies are interleaved across chunks since later bodies have fewer pairs
+    left.
+
+    :param chunk: Index of the first body of the chunk.
+    :param n_chunks: Total number of chunks.
+    :param masses: A contiguous (N,) array of masses.
+    :param pos_x: A contiguous (N,) array of x coordinates.
+    :param pos_y: A contiguous (N,) array of y coordinates.
+    :param acc_x: A (N,) array the acceleration in x direction is added to.
+    :param acc_y: A (N,) array the acceleration in y direction is added to.
+    """
+
+    # skipping bodies of other chunks instead of looping over range(chunk, N, n_chunks)
+    # keeps the inner loop vectorizable, see `_row_interactions`
+    for i in range(len(masses)):
+        if i % n_chunks != chunk:
+            continue
+
+        acc_x_i, acc_y_i = _row_interactions(i, masses, pos_x, pos_y, acc_x, acc_y)
+        acc_x[i] += acc_x_i
+        acc_y[i] += acc_y_i
+
+
+@njit(cache=True)
+def _serial_acceleration_kernel(masses, pos_x, pos_y, acc_x, acc_y):
+    """
+    Internal kernel used to calculate the acceleration for each body on a
+    single thread. Each pair of bodies is only considered once and Newton's
+    third law is used to apply the opposite contribution to the second body.
+
+    :param masses: A contiguous (N,) array of masses.
+    :param pos_x: A contiguous (N,) array of x coordinates.
+    :param pos_y: A contiguous (N,) array of y coordinates.
+    :param acc_x: A (N,) array the acceleration in x direction is written to.
+    :param acc_y: A (N,) array the acceleration in y direction is written to.
+    """
+
+    acc_x[:] = 0.0
+    acc_y[:] = 0.0
+
+    _chunk_interactions(0, 1, masses, pos_x, pos_y, acc_x, acc_y)
+
+
+@njit(cache=True, parallel=True)
+def _parallel_acceleration_kernel(masses, pos_x, pos_y, acc_x, acc_y):
+    """
+    Internal kernel used to calculate the acceleration for each body. Each
+    pair of bodies is only considered once and Newton's third law is used to
+    apply the opposite contribution to the second body. The pairs are
+    distributed across all CPU threads, each of which accumulates into its
+    own buffer to avoid race conditions. The buffers are summed up at the end.
+
+    :param masses: A contiguous (N,) array of masses.
+    :param pos_x: A contiguous (N,) array of x coordinates.
+    :param pos_y: A contiguous (N,) array of y coordinates.
+    :param acc_x: A (N,) array the acceleration in x direction is written to.
+    :param acc_y: A (N,) array the acceleration in y direction is written to.
+    """
+
+    n = len(masses)
+    n_chunks = max(1, min(num_chunks, n))
+    partial_acc = np.zeros((n_chunks, 2, n))
+
+    for chunk in prange(n_chunks):
+        _chunk_interactions(
+            chunk, n_chunks, masses, pos_x, pos_y, partial_acc[chunk, 0], partial_acc[chunk, 1]
+        )
+
+    for i in prange(n):
+        acc_x[i] = partial_acc[:, 0, i].sum()
+        acc_y[i] = partial_acc[:, 1, i].sum()
+
+
+@njit(cache=True)
+def _acceleration_kernel(masses, pos_x, pos_y, acc_x, acc_y):
+    """
+    Internal kernel used to calculate the acceleration for each body. Depending
+    on the number of bodies, the calculation is run on one or all CPU threads.
+
+    :param masses: A contiguous (N,) array of masses.
+    :param pos_x: A contiguous (N,) array of x coordinates.
+    :param pos_y: A contiguous (N,) array of y coordinates.
+    :param acc_x: A (N,) array the acceleration in x direction is written to.
+    :param acc_y: A (N,) array the acceleration in y direction is written to.
+    """
+
+    if len(masses) < parallel_threshold:
+        _serial_acceleration_kernel(masses, pos_x, pos_y, acc_x, acc_y)
+    else:
+        _parallel_acceleration_kernel(masses, pos_x, pos_y, acc_x, acc_y)
+
+
+@njit(cache=True)
+def acceleration(masses, current_pos, out=None):
+    """
+    Calculates the acceleration for each body in both x & y direction based on
+    the gravitational force using a compiled and parallelized direct sum approach.
+
+    :param masses: A (N,) array of masses.
+    :param current_pos: A (N, 2) array of current positions of all bodies.
+    :param out: Optional (N, 2) array the accelerations are written to.
+    :return: A (N, 2) array of accelerations.
+    """
+
+    # split positions into contiguous x & y coordinates
+    pos_x = current_pos[:, 0].copy()
+    pos_y = current_pos[:, 1].copy()
+
+    acc_x = np.empty_like(pos_x)
+    acc_y = np.empty_like(pos_y)
+    _acceleration_kernel(masses, pos_x, pos_y, acc_x, acc_y)
+
+    if out is None:
+        out = np.empty((len(masses), 2))
+    out[:, 0] = acc_x
+    out[:, 1] = acc_y
+
+    return out
+
+
+@njit(cache=True, parallel=True, fastmath=True, error_model="numpy")
+def _energy_kernel(masses, pos, vel):
+    """
+    Internal kernel used to calculate the energies for each time step for
+    any number of bodies, see `energy` function below.
+    """
+
+    time_steps, n = pos.shape[:2]
+    kin_energy = np.empty(time_steps)
+    pot_energy = np.empty(time_steps)
+
+    for t in prange(time_steps):
+        kin = 0.0
+        for i in range(n):
+            kin += masses[i] * (vel[t, i, 0] * vel[t, i, 0] + vel[t, i, 1] * vel[t, i, 1])
+
+        pot = 0.0
+        for i in range(n - 1):
+            x_i = pos[t, i, 0]
+            y_i = pos[t, i, 1]
+
+            # contributions of all bodies j > i, see `_row_interactions`
+            pot_i = 0.0
+            for offset in range(n - i - 1):
+                j = i + 1 + offset
+                dx = x_i - pos[t, j, 0]
+                dy = y_i - pos[t, j, 1]
+                pot_i += masses[j] / np.sqrt(dx * dx + dy * dy)
+
+            pot -= masses[i] * pot_i
+
+        kin_energy[t] = 0.5 * kin
+        pot_energy[t] = pot
+
+    return kin_energy, pot_energy, kin_energy + pot_energy
+
+
+def _build_energy_kernel(n):
+    """
+    Internal function used to generate an energy kernel specialized for a
+    fixed number of bodies. The loops over the bodies and pairs of bodies are
+    written out such that the masses and coordinates are held in registers.
+
+    :param n: Number of bodies.
+    :return: Numba compiled kernel with the same signature as `_energy_kernel`.
+    """
+
+    pairs = [(i, j) for i in range(n) for j in range(i + 1, n)]
+
+    lines = [
+        "def energy_kernel(masses, pos, vel):",
+        "    time_steps = pos.shape[0]",
+        "    kin_energy = np.empty(time_steps)",
+        "    pot_energy = np.empty(time_steps)",
+    ]
+    lines += [f"    m{i} = masses[{i}]" for i in range(n)]
+    lines += [f"    m{i}_{j} = m{i} * m{j}" for i, j in pairs]
+    lines.append("    for t in prange(time_steps):")
+
+    for i in range(n):
+        lines.append(f"        x{i} = pos[t, {i}, 0]")
+        lines.append(f"        y{i} = pos[t, {i}, 1]")
+
+    kin_terms = (
+        f"m{i} * (vel[t, {i}, 0] * vel[t, {i}, 0] + vel[t, {i}, 1] * vel[t, {i}, 1])"
+        for i in range(n)
+    )
+    pot_terms = (
+        f"m{i}_{j} / np.sqrt((x{i} - x{j}) * (x{i} - x{j}) + (y{i} - y{j}) * (y{i} - y{j}))"
+        for i, j in pairs
+    )
+    lines.append(f"        kin_energy[t] = 0.5 * ({' + '.join(kin_terms)})")
+    lines.append(f"        pot_energy[t] = -({' + '.join(pot_terms) or '0.0'})")
+    lines.append("    return kin_energy, pot_energy, kin_energy + pot_energy")
+
+    namespace = {"np": np, "prange": prange}
+    exec("\n".join(lines), namespace)
+
+    # generated code has no source file, so it cannot be cached on disk
+    return njit(parallel=True, fastmath=True, error_model="numpy")(namespace["energy_kernel"])
+
+
+def energy(masses, pos, vel):
+    """
+    Calculates kinetic energy, gravitational potential energy, and total
+    energy for the whole system for each time step in the simulation, see
+    `calculate_energy` in `utils`. The time steps are distributed across all
+    CPU threads and each pair of bodies is only considered once without
+    allocating any intermediate arrays.
+
+    For few bodies and very long simulations, a kernel specialized for the
+    number of bodies is generated and compiled at runtime, see
+    `_build_energy_kernel`. Compiled kernels are reused for the same number
+    of bodies within a Python session. Otherwise, the general kernel is used,
+    which is loaded from the on-disk cache without compiling.
+
+    :param masses: A (N,) array of masses.
+    :param pos: A (T, N, 2) array of positions over time.
+    :param vel: A (T, N, 2) array of velocities over time.
+    :return: Tuple of kinetic energy over time, potential
+             energy over time, and total energy over time.
+    """
+
+    n = len(masses)
+    if n not in _energy_kernels:
+        if n > max_unrolled_bodies or pos.shape[0] < min_unrolled_time_steps:
+            return _energy_kernel(masses, pos, vel)
+
+        _energy_kernels[n] = _build_energy_kernel(n)
+
+    return _energy_kernels[n](masses, pos, vel)
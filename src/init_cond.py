@@ -42,14 +42,22 @@ def generate_planetary_system(bodies, max_mass=1e-3, seed=None):
     masses = rng.uniform(0, max_mass, (bodies,))
 
     # generate polar coordinates & convert to cartesian
+    # results are written directly into contiguous (n, 2) arrays
     theta = rng.uniform(0, 2 * np.pi, (bodies,))
     r = rng.gamma(7.5, 1, (bodies,)) * bodies ** 0.8
-    pos = np.vstack((r * np.cos(theta), r * np.sin(theta))).T
+    cos_theta = np.cos(theta)
+    sin_theta = np.sin(theta)
+
+    pos = np.empty((bodies, 2))
+    np.multiply(r, cos_theta, out=pos[:, 0])
+    np.multiply(r, sin_theta, out=pos[:, 1])
 
     # calculate magnitude of velocity under the approximation of a two-body system
     v = np.sqrt(1 / r)
 
-    vel = np.vstack((-v * np.sin(theta), v * np.cos(theta))).T
+    vel = np.empty((bodies, 2))
+    np.multiply(-v, sin_theta, out=vel[:, 0])
+    np.multiply(v, cos_theta, out=vel[:, 1])
 
     # overwrite first body with heavy central mass
     masses[0] = 1
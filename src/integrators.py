@@ -14,10 +14,34 @@ __credits__ = ["jeypiti", "Lvisss"]
 __license__ = "MIT"
 
 
+# Butcher tableau of the eighth-order Runge-Kutta method, see `rk8` function below
+# fmt: off
+rk8_a = np.array(
+    (
+        (                      0,      0,        0,                          0,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
+        (                 1 / 18,      0,        0,                          0,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
+        (                 1 / 48, 1 / 16,        0,                          0,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
+        (                 1 / 32,      0,   3 / 32,                          0,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
+        (                 5 / 16,      0, -75 / 64,                    75 / 64,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
+        (                 3 / 80,      0,        0,                     3 / 16,                  3 / 20,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
+        (   29443841 / 614563906,      0,        0,       77736538 / 692538347,  -28693883 / 1125000000,     23124283 / 1800000000,                         0,                         0,                         0,                       0,                      0, 0, 0),
+        (   16016141 / 946692911,      0,        0,       61564180 / 158732637,    22789713 / 633445777,    545815736 / 2771057229,   -180193667 / 1043307555,                         0,                         0,                       0,                      0, 0, 0),
+        (   39632708 / 573591083,      0,        0,     -433636366 / 683701615, -421739975 / 2616292301,     100302831 / 723423059,     790204164 / 839813087,    800635310 / 3783071287,                         0,                       0,                      0, 0, 0),
+        ( 246121993 / 1340847787,      0,        0, -37695042795 / 15268766246, -309121744 / 1061227803,     -12992083 / 490766935,   6005943493 / 2108947869,    393006217 / 1396673457,    123872331 / 1001029789,                       0,                      0, 0, 0),
+        (-1028468189 / 846180014,      0,        0,     8478235783 / 508512852, 1311729495 / 1432422823, -10304129995 / 1701304382, -48777925059 / 3047939560,  15336726248 / 1032824649, -45442868181 / 3398467696,  3065993473 / 597172653,                      0, 0, 0),
+        (  185892177 / 718116043,      0,        0,    -3185094517 / 667107341, -477755414 / 1098053517,    -703635378 / 230739211,   5731566787 / 1027545527,    5232866602 / 850066563,   -4093664535 / 808688257, 3962137247 / 1805957418,   65686358 / 487910083, 0, 0),
+        (  403863854 / 491063109,      0,        0,    -5068492393 / 434740067,  -411421997 / 543043805,     652783627 / 914296604,   11173962825 / 925320556, -13158990841 / 6184727034,   3936647629 / 1978049680,  -160528059 / 685178525, 248638103 / 1413531060, 0, 0),
+    )
+)
+rk8_b = np.array((14005451 / 335480064, 0, 0, 0, 0, -59238493 / 1068277825, 181606767 / 758867731, 561292985 / 797845732, -1041891430 / 1371343529, 760417239 / 1151165299, 118820643 / 751138087, -528747749 / 2220607170, 1 / 4))
+# fmt: on
+
+
 @solver
-def forward_euler(masses, pos, vel, dt, acc):
+def forward_euler(masses, pos, vel, dt, acc, pot_energy=None):
     """
     Solves N body simulation using the forward Euler method.
+    Supports tracking the energy during the integration, see `solver` decorator.
 
     :param masses: List of N masses.
     :param pos: Nearly empty list for time evolution of x & y coordinates for N bodies.
@@ -26,14 +50,31 @@ def forward_euler(masses, pos, vel, dt, acc):
                 Only initial conditions should be specified.
     :param dt: Time step for the simulation.
     :param acc: Callable that calculates the acceleration acting on the bodies.
-                Takes an (N,) array of masses and an (N, 2) array of current
-                positions. Returns an (N, 2) array of accelerations.
+                Takes an (N,) array of masses, an (N, 2) array of current
+                positions, and an (N, 2) array passed as `out` the result is
+                written to. Returns an (N, 2) array of accelerations.
+    :param pot_energy: Optional array the potential energy of all but the last
+                       time step is written to. Requires acc to take a pot_out
+                       argument, e.g. `acceleration_vec` in `direct_sum`.
     :return: Time evolution of x & y coordinates for N bodies.
     """
 
-    for time_idx in range(pos.shape[2] - 1):
-        pos[:, :, time_idx + 1] = pos[:, :, time_idx] + dt * vel[:, :, time_idx]
-        vel[:, :, time_idx + 1] = vel[:, :, time_idx] + dt * acc(masses, pos[:, :, time_idx])
+    # reuse the same buffer for the acceleration in every time step
+    acc_buf = np.empty_like(pos[0])
+
+    for time_idx in range(pos.shape[0] - 1):
+        if pot_energy is None:
+            acc_now = acc(masses, pos[time_idx], out=acc_buf)
+        else:
+            # the acceleration is evaluated at the current state, so its energy comes for free
+            pot_out = pot_energy[time_idx : time_idx + 1]
+            acc_now = acc(masses, pos[time_idx], out=acc_buf, pot_out=pot_out)
+
+        # write the products directly into the next time step to avoid temporary arrays
+        np.multiply(vel[time_idx], dt, out=pos[time_idx + 1])
+        pos[time_idx + 1] += pos[time_idx]
+        np.multiply(acc_now, dt, out=vel[time_idx + 1])
+        vel[time_idx + 1] += vel[time_idx]
 
     return pos, vel
 
@@ -50,20 +91,30 @@ def leapfrog(masses, pos, vel, dt, acc):
                 Only initial conditions should be specified.
     :param dt: Time step for the simulation.
     :param acc: Callable that calculates the acceleration acting on the bodies.
-                Takes an (N,) array of masses and an (N, 2) array of current
-                positions. Returns an (N, 2) array of accelerations.
+                Takes an (N,) array of masses, an (N, 2) array of current
+                positions, and an (N, 2) array passed as `out` the result is
+                written to. Returns an (N, 2) array of accelerations.
     :return: Time evolution of x & y coordinates for N bodies.
     """
 
-    for time_idx in range(pos.shape[2] - 1):
+    half_dt = 0.5 * dt
+
+    # reuse the same buffer for the acceleration in every time step,
+    # it also holds the intermediate results of the in-place updates
+    acc_buf = np.empty_like(pos[0])
+
+    for time_idx in range(pos.shape[0] - 1):
         # update next time step with 1/2 drift
-        pos[:, :, time_idx + 1] = pos[:, :, time_idx] + 0.5 * dt * vel[:, :, time_idx]
+        np.multiply(vel[time_idx], half_dt, out=pos[time_idx + 1])
+        pos[time_idx + 1] += pos[time_idx]
 
         # use 1/2 drift step for full kick step
-        vel[:, :, time_idx + 1] = vel[:, :, time_idx] + dt * acc(masses, pos[:, :, time_idx + 1])
+        acc(masses, pos[time_idx + 1], out=acc_buf)
+        acc_buf *= dt
+        np.add(vel[time_idx], acc_buf, out=vel[time_idx + 1])
 
         # another 1/2 drift
-        pos[:, :, time_idx + 1] = pos[:, :, time_idx + 1] + 0.5 * dt * vel[:, :, time_idx + 1]
+        pos[time_idx + 1] += np.multiply(vel[time_idx + 1], half_dt, out=acc_buf)
 
     return pos, vel
 
@@ -84,8 +135,75 @@ def pefrl(masses, pos, vel, dt, acc):
                 Only initial conditions should be specified.
     :param dt: Time step for the simulation.
     :param acc: Callable that calculates the acceleration acting on the bodies.
-                Takes an (N,) array of masses and an (N, 2) array of current
-                positions. Returns an (N, 2) array of accelerations.
+                Takes an (N,) array of masses, an (N, 2) array of current
+                positions, and an (N, 2) array passed as `out` the result is
+                written to. Returns an (N, 2) array of accelerations.
+    :return: Time evolution of x & y coordinates for N bodies.
+    """
+
+    xi = 1.786178958448091e-1
+    lbd = -2.123418310626054e-1
+    chi = -6.626458266981849e-2
+
+    # coefficients of the sub steps scaled by the time step
+    xi_dt = xi * dt
+    chi_dt = chi * dt
+    lbd_dt = lbd * dt
+    half_minus_lbd_dt = (0.5 - lbd) * dt
+    one_minus_two_chi_xi_dt = (1 - 2 * (chi + xi)) * dt
+
+    # reuse the same buffers for the acceleration and the running state of the sub steps,
+    # tmp_buf holds the scaled velocity or acceleration before it is added to the state
+    acc_buf = np.empty_like(pos[0])
+    pos_buf = np.empty_like(pos[0])
+    vel_buf = np.empty_like(pos[0])
+    tmp_buf = np.empty_like(pos[0])
+
+    for i in range(pos.shape[0] - 1):
+        pos_buf[:] = pos[i]
+        vel_buf[:] = vel[i]
+
+        # alternate drift and kick sub steps
+        for pos_coeff, vel_coeff in (
+            (xi_dt, half_minus_lbd_dt),
+            (chi_dt, lbd_dt),
+            (one_minus_two_chi_xi_dt, lbd_dt),
+            (chi_dt, half_minus_lbd_dt),
+        ):
+            pos_buf += np.multiply(vel_buf, pos_coeff, out=tmp_buf)
+            vel_buf += np.multiply(acc(masses, pos_buf, out=acc_buf), vel_coeff, out=tmp_buf)
+
+        # final drift
+        vel[i + 1] = vel_buf
+        np.multiply(vel_buf, xi_dt, out=pos[i + 1])
+        pos[i + 1] += pos_buf
+
+    return pos, vel
+
+
+@solver
+def pefrl_predictor(masses, pos, vel, dt, acc):
+    """
+    Solves N body simulation using an approximation of the position extended
+    Forest-Ruth-like integrator, see `pefrl` function above. Instead of
+    calculating the accelerations of the four sub steps one after another,
+    the positions of all sub steps are predicted in advance using the
+    acceleration of the last sub step of the previous time step. The
+    accelerations at the predicted positions are then calculated in a single
+    batched call and used to correct the velocities and positions. This trades
+    accuracy for speed and is mainly intended for diagnostic runs.
+
+    :param masses: List of N masses.
+    :param pos: Nearly empty list for time evolution of x & y coordinates for N bodies.
+                Only initial conditions should be specified.
+    :param vel: Nearly empty list for time evolution of x & y velocities for N bodies.
+                Only initial conditions should be specified.
+    :param dt: Time step for the simulation.
+    :param acc: Callable that calculates the acceleration acting on the bodies.
+                Takes an (N,) array of masses, a (B, N, 2) array of B sets of
+                positions, and a (B, N, 2) array passed as `out` the result is
+                written to. Returns a (B, N, 2) array of accelerations,
+                e.g. `acceleration_vec_batched` in `direct_sum`.
     :return: Time evolution of x & y coordinates for N bodies.
     """
 
@@ -93,20 +211,41 @@ def pefrl(masses, pos, vel, dt, acc):
     lbd = -2.123418310626054e-1
     chi = -6.626458266981849e-2
 
-    for i in range(pos.shape[2] - 1):
-        pos1 = pos[:, :, i] + xi * dt * vel[:, :, i]
-        vel1 = vel[:, :, i] + (0.5 - lbd) * dt * acc(masses, pos1)
+    # positions and accelerations of the four sub steps
+    pos_batch = np.empty((4, len(masses), 2), dtype=pos.dtype)
+    acc_batch = np.empty((4, len(masses), 2), dtype=pos.dtype)
+
+    # the first time step is predicted using the acceleration at the initial positions
+    acc(masses, pos[0:1], out=acc_batch[3:])
 
-        pos2 = pos1 + chi * dt * vel1
-        vel2 = vel1 + lbd * dt * acc(masses, pos2)
+    for i in range(pos.shape[0] - 1):
+        # predict sub step positions by assuming a constant acceleration
+        acc_pred = acc_batch[3].copy()
 
-        pos3 = pos2 + (1 - 2 * (chi + xi)) * dt * vel2
-        vel3 = vel2 + lbd * dt * acc(masses, pos3)
+        pos_batch[0] = pos[i] + xi * dt * vel[i]
+        vel1 = vel[i] + (0.5 - lbd) * dt * acc_pred
 
+        pos_batch[1] = pos_batch[0] + chi * dt * vel1
+        vel2 = vel1 + lbd * dt * acc_pred
+
+        pos_batch[2] = pos_batch[1] + (1 - 2 * (chi + xi)) * dt * vel2
+        vel3 = vel2 + lbd * dt * acc_pred
+
+        pos_batch[3] = pos_batch[2] + chi * dt * vel3
+
+        # calculate accelerations of all sub steps at once
+        acc(masses, pos_batch, out=acc_batch)
+
+        # correct the sub steps using the accelerations at the predicted positions
+        vel1 = vel[i] + (0.5 - lbd) * dt * acc_batch[0]
+        vel2 = vel1 + lbd * dt * acc_batch[1]
+        vel3 = vel2 + lbd * dt * acc_batch[2]
+
+        pos3 = pos_batch[0] + chi * dt * vel1 + (1 - 2 * (chi + xi)) * dt * vel2
         pos4 = pos3 + chi * dt * vel3
 
-        vel[:, :, i + 1] = vel3 + (0.5 - lbd) * dt * acc(masses, pos4)
-        pos[:, :, i + 1] = pos4 + xi * dt * vel[:, :, i + 1]
+        vel[i + 1] = vel3 + (0.5 - lbd) * dt * acc_batch[3]
+        pos[i + 1] = pos4 + xi * dt * vel[i + 1]
 
     return pos, vel
 
@@ -125,44 +264,41 @@ def rk8(masses, pos, vel, dt, acc):
                 Only initial conditions should be specified.
     :param dt: Time step for the simulation.
     :param acc: Callable that calculates the acceleration acting on the bodies.
-                Takes an (N,) array of masses and an (N, 2) array of current
-                positions. Returns an (N, 2) array of accelerations.
+                Takes an (N,) array of masses, an (N, 2) array of current
+                positions, and an (N, 2) array passed as `out` the result is
+                written to. Returns an (N, 2) array of accelerations.
     :return: Time evolution of x & y coordinates for N bodies.
     """
 
-    # fmt: off
-    a = np.array(
-        (
-            (                      0,      0,        0,                          0,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
-            (                 1 / 18,      0,        0,                          0,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
-            (                 1 / 48, 1 / 16,        0,                          0,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
-            (                 1 / 32,      0,   3 / 32,                          0,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
-            (                 5 / 16,      0, -75 / 64,                    75 / 64,                       0,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
-            (                 3 / 80,      0,        0,                     3 / 16,                  3 / 20,                         0,                         0,                         0,                         0,                       0,                      0, 0, 0),
-            (   29443841 / 614563906,      0,        0,       77736538 / 692538347,  -28693883 / 1125000000,     23124283 / 1800000000,                         0,                         0,                         0,                       0,                      0, 0, 0),
-            (   16016141 / 946692911,      0,        0,       61564180 / 158732637,    22789713 / 633445777,    545815736 / 2771057229,   -180193667 / 1043307555,                         0,                         0,                       0,                      0, 0, 0),
-            (   39632708 / 573591083,      0,        0,     -433636366 / 683701615, -421739975 / 2616292301,     100302831 / 723423059,     790204164 / 839813087,    800635310 / 3783071287,                         0,                       0,                      0, 0, 0),
-            ( 246121993 / 1340847787,      0,        0, -37695042795 / 15268766246, -309121744 / 1061227803,     -12992083 / 490766935,   6005943493 / 2108947869,    393006217 / 1396673457,    123872331 / 1001029789,                       0,                      0, 0, 0),
-            (-1028468189 / 846180014,      0,        0,     8478235783 / 508512852, 1311729495 / 1432422823, -10304129995 / 1701304382, -48777925059 / 3047939560,  15336726248 / 1032824649, -45442868181 / 3398467696,  3065993473 / 597172653,                      0, 0, 0),
-            (  185892177 / 718116043,      0,        0,    -3185094517 / 667107341, -477755414 / 1098053517,    -703635378 / 230739211,   5731566787 / 1027545527,    5232866602 / 850066563,   -4093664535 / 808688257, 3962137247 / 1805957418,   65686358 / 487910083, 0, 0),
-            (  403863854 / 491063109,      0,        0,    -5068492393 / 434740067,  -411421997 / 543043805,     652783627 / 914296604,   11173962825 / 925320556, -13158990841 / 6184727034,   3936647629 / 1978049680,  -160528059 / 685178525, 248638103 / 1413531060, 0, 0),
-        )
-    )
-    b = np.array((14005451 / 335480064, 0, 0, 0, 0, -59238493 / 1068277825, 181606767 / 758867731, 561292985 / 797845732, -1041891430 / 1371343529, 760417239 / 1151165299, 118820643 / 751138087, -528747749 / 2220607170, 1 / 4))
-    # fmt: on
+    k = np.zeros((len(masses), 2, len(rk8_b)), dtype=pos.dtype)
+    j = np.zeros((len(masses), 2, len(rk8_b)), dtype=pos.dtype)
+
+    # scratch buffers for the weighted sums over the sub steps, reused in every step
+    k_sum = np.empty_like(pos[0])
+    j_sum = np.empty_like(pos[0])
+    acc_buf = np.empty_like(pos[0])
+
+    for time_idx in range(pos.shape[0] - 1):
+
+        for sub_step in range(len(rk8_b)):
+            # the Butcher tableau is lower triangular, only previous sub steps contribute
+            coeffs = rk8_a[sub_step, :sub_step]
+            np.matmul(k[:, :, :sub_step], coeffs, out=k_sum)
+            np.matmul(j[:, :, :sub_step], coeffs, out=j_sum)
 
-    k = np.zeros((len(masses), 2, len(b)))
-    j = np.zeros((len(masses), 2, len(b)))
+            # velocity of the sub step
+            j_sum *= dt
+            np.add(vel[time_idx], j_sum, out=k[:, :, sub_step])
 
-    for time_idx in range(pos.shape[2] - 1):
+            # acceleration at the position of the sub step
+            k_sum *= dt
+            k_sum += pos[time_idx]
+            j[:, :, sub_step] = acc(masses, k_sum, out=acc_buf)
 
-        for sub_step in range(len(b)):
-            k[:, :, sub_step] = vel[:, :, time_idx] + dt * np.sum(a[sub_step, :] * j, axis=2)
-            j[:, :, sub_step] = acc(
-                masses, pos[:, :, time_idx] + dt * np.sum(a[sub_step, :] * k, axis=2)
-            )
+        np.matmul(k, rk8_b, out=k_sum)
+        np.matmul(j, rk8_b, out=j_sum)
 
-        pos[:, :, time_idx + 1] = pos[:, :, time_idx] + dt * np.sum(b * k, axis=2)
-        vel[:, :, time_idx + 1] = vel[:, :, time_idx] + dt * np.sum(b * j, axis=2)
+        pos[time_idx + 1] = pos[time_idx] + dt * k_sum
+        vel[time_idx + 1] = vel[time_idx] + dt * j_sum
 
     return pos, vel
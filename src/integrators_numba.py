@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+"""n-body-sim: src/integrators_numba
+Implementations of different integration methods compiled to machine code
+using Numba. The acceleration is calculated by compiled kernels and called
+directly from the compiled integration loops.
+
+The integrators mirror the ones in `integrators` but require the acceleration
+function to be compiled with Numba as well, e.g. `acceleration` in
+`direct_sum_numba` or `barnes_hut_numba`.
+"""
+import numpy as np
+from numba import njit, prange
+
+from direct_sum_numba import _acceleration_kernel, parallel_threshold
+from integrators import rk8_a, rk8_b
+from utils import solver
+
+
+__author__ = "jeypiti"
+__copyright__ = "Copyright 2022, jeypiti"
+__credits__ = ["jeypiti"]
+__license__ = "MIT"
+
+
+# largest number of bodies for which the loop over the bodies is unrolled in `rk8_unrolled`
+max_unrolled_bodies = 8
+
+# RK8 kernels generated by `_build_rk8_kernel`, keyed by the number of bodies
+_rk8_kernels = {}
+
+
+@njit(cache=True, fastmath=True)
+def evolve_euler(masses, pos0, vel0, dt, n_steps, stride, out_pos, out_vel):
+    """
+    Solves N body simulation using the forward Euler method with the direct
+    sum acceleration fused into the integration loop. Instead of keeping the
+    full time evolution, the state is only recorded every `stride` time steps,
+    which keeps the working set small for long simulations.
+
+    :param masses: A (N,) array of masses.
+    :param pos0: A (N, 2) array of initial positions.
+    :param vel0: A (N, 2) array of initial velocities.
+    :param dt: Time step for the simulation.
+    :param n_steps: Number of time steps to integrate.
+    :param stride: Number of time steps between two recorded states.
+    :param out_pos: A (n_steps // stride + 1, N, 2) array the
+                    positions are recorded to, starting with pos0.
+    :param out_vel: A (n_steps // stride + 1, N, 2) array the
+                    velocities are recorded to, starting with vel0.
+    :return: Recorded time evolution of x & y coordinates and velocities for N bodies.
+    """
+
+    # current state split into contiguous x & y components
+    pos_x = pos0[:, 0].copy()
+    pos_y = pos0[:, 1].copy()
+    vel_x = vel0[:, 0].copy()
+    vel_y = vel0[:, 1].copy()
+    acc_x = np.empty_like(pos_x)
+    acc_y = np.empty_like(pos_y)
+
+    out_pos[0] = pos0
+    out_vel[0] = vel0
+
+    for step in range(1, n_steps + 1):
+        _acceleration_kernel(masses, pos_x, pos_y, acc_x, acc_y)
+
+        for i in range(len(masses)):
+            pos_x[i] += dt * vel_x[i]
+            pos_y[i] += dt * vel_y[i]
+            vel_x[i] += dt * acc_x[i]
+            vel_y[i] += dt * acc_y[i]
+
+        if step % stride == 0:
+            record_idx = step // stride
+            out_pos[record_idx, :, 0] = pos_x
+            out_pos[record_idx, :, 1] = pos_y
+            out_vel[record_idx, :, 0] = vel_x
+            out_vel[record_idx, :, 1] = vel_y
+
+    return out_pos, out_vel
+
+
+@njit(inline="always", fastmath=True)
+def _weighted_sum_row(i, out, base, scale, coeffs, stages):
+    """
+    Internal function used to calculate the weighted sum of the sub steps
+    for body i, see `_weighted_sum` function below.
+    """
+
+    for d in range(2):
+        total = 0.0
+        for stage in range(len(coeffs)):
+            total += coeffs[stage] * stages[stage, i, d]
+
+        out[i, d] = base[i, d] + scale * total
+
+
+@njit(inline="always", fastmath=True)
+def _serial_weighted_sum(out, base, scale, coeffs, stages):
+    """
+    Internal kernel used to calculate the weighted sum of the sub steps for
+    each body on a single thread, see `_weighted_sum` function below.
+    """
+
+    for i in range(len(out)):
+        _weighted_sum_row(i, out, base, scale, coeffs, stages)
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def _parallel_weighted_sum(out, base, scale, coeffs, stages):
+    """
+    Internal kernel used to calculate the weighted sum of the sub steps for
+    each body, distributing the bodies across all CPU threads, see
+    `_weighted_sum` function below.
+    """
+
+    for i in prange(len(out)):
+        _weighted_sum_row(i, out, base, scale, coeffs, stages)
+
+
+@njit(inline="always")
+def _weighted_sum(out, base, scale, coeffs, stages):
+    """
+    Internal kernel used to update the state of all bodies from the
+    quantities of multiple sub steps, i.e. out = base + scale * sum of
+    coeffs[s] * stages[s]. Depending on the number of bodies, the
+    calculation is run on one or all CPU threads.
+
+    :param out: A (N, 2) array the result is written to. May be the same as base.
+    :param base: A (N, 2) array of the state at the beginning of the time step.
+    :param scale: Factor the weighted sum is multiplied with, e.g. the time step.
+    :param coeffs: A (S,) array of weights of the sub steps.
+    :param stages: A (S, N, 2) array of quantities of the sub steps.
+    """
+
+    if len(out) < parallel_threshold:
+        _serial_weighted_sum(out, base, scale, coeffs, stages)
+    else:
+        _parallel_weighted_sum(out, base, scale, coeffs, stages)
+
+
+@solver
+@njit(cache=True, fastmath=True)
+def forward_euler(masses, pos, vel, dt, acc):
+    """
+    Solves N body simulation using the forward Euler method.
+
+    :param masses: List of N masses.
+    :param pos: Nearly empty list for time evolution of x & y coordinates for N bodies.
+                Only initial conditions should be specified.
+    :param vel: Nearly empty list for time evolution of x & y velocities for N bodies.
+                Only initial conditions should be specified.
+    :param dt: Time step for the simulation.
+    :param acc: Numba compiled function that calculates the acceleration acting on the
+                bodies. Takes an (N,) array of masses, an (N, 2) array of current
+                positions, and an (N, 2) array passed as `out` the result is written to.
+    :return: Time evolution of x & y coordinates for N bodies.
+    """
+
+    n = len(masses)
+    acc_buf = np.empty((n, 2))
+
+    for time_idx in range(pos.shape[0] - 1):
+        acc(masses, pos[time_idx], out=acc_buf)
+
+        for i in range(n):
+            for d in range(2):
+                pos[time_idx + 1, i, d] = pos[time_idx, i, d] + dt * vel[time_idx, i, d]
+                vel[time_idx + 1, i, d] = vel[time_idx, i, d] + dt * acc_buf[i, d]
+
+    return pos, vel
+
+
+@solver
+@njit(cache=True, fastmath=True)
+def leapfrog(masses, pos, vel, dt, acc, acc_every=1):
+    """
+    Solves N body simulation using the leapfrog method.
+
+    For few bodies, calculating the acceleration is cheap compared to the
+    overhead of each call. If the forces vary slowly compared to the time
+    step, the acceleration can be reused for acc_every time steps. This is
+    an approximation that breaks the symplecticity of the method, so the
+    default of calculating it in every time step should be kept unless the
+    energy of the system is monitored.
+
+    :param masses: List of N masses.
+    :param pos: Nearly empty list for time evolution of x & y coordinates for N bodies.
+                Only initial conditions should be specified.
+    :param vel: Nearly empty list for time evolution of x & y velocities for N bodies.
+                Only initial conditions should be specified.
+    :param dt: Time step for the simulation.
+    :param acc: See `forward_euler` function above.
+    :param acc_every: Number of time steps the acceleration is reused for.
+    :return: Time evolution of x & y coordinates for N bodies.
+    """
+
+    # compiled functions only support constant exception messages
+    if acc_every < 1:
+        raise ValueError("acc_every must be at least 1.")
+
+    n = len(masses)
+    acc_buf = np.empty((n, 2))
+
+    for time_idx in range(pos.shape[0] - 1):
+        # update next time step with 1/2 drift
+        for i in range(n):
+            for d in range(2):
+                pos[time_idx + 1, i, d] = pos[time_idx, i, d] + 0.5 * dt * vel[time_idx, i, d]
+
+        # use 1/2 drift step for full kick step followed by another 1/2 drift
+        if time_idx % acc_every == 0:
+            acc(masses, pos[time_idx + 1], out=acc_buf)
+
+        for i in range(n):
+            for d in range(2):
+                vel[time_idx + 1, i, d] = vel[time_idx, i, d] + dt * acc_buf[i, d]
+                pos[time_idx + 1, i, d] += 0.5 * dt * vel[time_idx + 1, i, d]
+
+    return pos, vel
+
+
+@solver
+@njit(cache=True, fastmath=True)
+def pefrl(masses, pos, vel, dt, acc):
+    """
+    Solves N body simulation using the position extended Forest-Ruth-like
+    integrator, see `pefrl` function in `integrators`.
+
+    :param masses: List of N masses.
+    :param pos: Nearly empty list for time evolution of x & y coordinates for N bodies.
+                Only initial conditions should be specified.
+    :param vel: Nearly empty list for time evolution of x & y velocities for N bodies.
+                Only initial conditions should be specified.
+    :param dt: Time step for the simulation.
+    :param acc: See `forward_euler` function above.
+    :return: Time evolution of x & y coordinates for N bodies.
+    """
+
+    xi = 1.786178958448091e-1
+    lbd = -2.123418310626054e-1
+    chi = -6.626458266981849e-2
+
+    # position and velocity coefficients of the sub steps
+    pos_coeff = (xi * dt, chi * dt, (1 - 2 * (chi + xi)) * dt, chi * dt)
+    vel_coeff = ((0.5 - lbd) * dt, lbd * dt, lbd * dt, (0.5 - lbd) * dt)
+
+    n = len(masses)
+    pos_sub = np.empty((n, 2))
+
+    # velocities and accelerations are stored as a single sub step for `_weighted_sum`
+    vel_sub = np.empty((1, n, 2))
+    acc_buf = np.empty((1, n, 2))
+    one = np.ones(1)
+
+    for time_idx in range(pos.shape[0] - 1):
+        pos_sub[:] = pos[time_idx]
+        vel_sub[0] = vel[time_idx]
+
+        # alternate drift and kick sub steps
+        for sub_step in range(4):
+            _weighted_sum(pos_sub, pos_sub, pos_coeff[sub_step], one, vel_sub)
+            acc(masses, pos_sub, out=acc_buf[0])
+            _weighted_sum(vel_sub[0], vel_sub[0], vel_coeff[sub_step], one, acc_buf)
+
+        # final drift
+        vel[time_idx + 1] = vel_sub[0]
+        _weighted_sum(pos[time_idx + 1], pos_sub, xi * dt, one, vel_sub)
+
+    return pos, vel
+
+
+@solver
+@njit(cache=True, fastmath=True)
+def rk8(masses, pos, vel, dt, acc):
+    """
+    Solves N body simulation using an eighth-order Runge-Kutta method,
+    see `rk8` function in `integrators`.
+
+    :param masses: List of N masses.
+    :param pos: Nearly empty list for time evolution of x & y coordinates for N bodies.
+                Only initial conditions should be specified.
+    :param vel: Nearly empty list for time evolution of x & y velocities for N bodies.
+                Only initial conditions should be specified.
+    :param dt: Time step for the simulation.
+    :param acc: See `forward_euler` function above.
+    :return: Time evolution of x & y coordinates for N bodies.
+    """
+
+    n = len(masses)
+    n_sub_steps = len(rk8_b)
+
+    # sub step velocities and accelerations, the first axis describes the sub step
+    k = np.empty((n_sub_steps, n, 2))
+    j = np.empty((n_sub_steps, n, 2))
+    pos_sub = np.empty((n, 2))
+
+    for time_idx in range(pos.shape[0] - 1):
+        for sub_step in range(n_sub_steps):
+            # the Butcher tableau is lower triangular, only previous sub steps contribute
+            coeffs = rk8_a[sub_step, :sub_step]
+            _weighted_sum(pos_sub, pos[time_idx], dt, coeffs, k[:sub_step])
+            _weighted_sum(k[sub_step], vel[time_idx], dt, coeffs, j[:sub_step])
+
+            acc(masses, pos_sub, out=j[sub_step])
+
+        _weighted_sum(pos[time_idx + 1], pos[time_idx], dt, rk8_b, k)
+        _weighted_sum(vel[time_idx + 1], vel[time_idx], dt, rk8_b, j)
+
+    return pos, vel
+
+
+def _build_rk8_kernel(n):
+    """
+    Internal function used to generate an RK8 integration loop specialized
+    for a fixed number of bodies. All sub steps are written out with the
+    coefficients of the Butcher tableau as literals such that vanishing
+    coefficients are skipped entirely. For few bodies, the loop over the
+    bodies is unrolled as well.
+
+    :param n: Number of bodies.
+    :return: Numba compiled integration loop with the same signature as `rk8`.
+    """
+
+    body_indices = [str(i) for i in range(n)] if n <= max_unrolled_bodies else ["i"]
+
+    def weighted_sum(coeffs, arr, body, dim):
+        return " + ".join(
+            f"{coeff!r} * {arr}[{sub_step}, {body}, {dim}]"
+            for sub_step, coeff in enumerate(coeffs)
+            if coeff != 0
+        )
+
+    def body_loop(lines_per_body, indent):
+        # either repeat the lines for every body or wrap them in a loop over the bodies
+        if n <= max_unrolled_bodies:
+            return [indent + line for body in body_indices for line in lines_per_body(body)]
+
+        lines = [indent + "for i in range(n):"]
+        lines += [indent + "    " + line for line in lines_per_body("i")]
+        return lines
+
+    lines = [
+        "def rk8_kernel(masses, pos, vel, dt, acc):",
+        "    n = len(masses)",
+        f"    k = np.empty(({len(rk8_b)}, n, 2))",
+        f"    j = np.empty(({len(rk8_b)}, n, 2))",
+        "    pos_sub = np.empty((n, 2))",
+        "    for time_idx in range(pos.shape[0] - 1):",
+    ]
+
+    for sub_step in range(len(rk8_b)):
+
+        def sub_step_lines(body, sub_step=sub_step):
+            result = []
+            for dim in range(2):
+                k_sum = weighted_sum(rk8_a[sub_step, :sub_step], "k", body, dim)
+                j_sum = weighted_sum(rk8_a[sub_step, :sub_step], "j", body, dim)
+                pos_t = f"pos[time_idx, {body}, {dim}]"
+                vel_t = f"vel[time_idx, {body}, {dim}]"
+                result.append(
+                    f"pos_sub[{body}, {dim}] = {pos_t}" + (f" + dt * ({k_sum})" if k_sum else "")
+                )
+                result.append(
+                    f"k[{sub_step}, {body}, {dim}] = {vel_t}"
+                    + (f" + dt * ({j_sum})" if j_sum else "")
+                )
+            return result
+
+        lines += body_loop(sub_step_lines, " " * 8)
+        lines.append(f"        acc(masses, pos_sub, out=j[{sub_step}])")
+
+    def final_lines(body):
+        result = []
+        for dim in range(2):
+            result.append(
+                f"pos[time_idx + 1, {body}, {dim}] = pos[time_idx, {body}, {dim}]"
+                f" + dt * ({weighted_sum(rk8_b, 'k', body, dim)})"
+            )
+            result.append(
+                f"vel[time_idx + 1, {body}, {dim}] = vel[time_idx, {body}, {dim}]"
+                f" + dt * ({weighted_sum(rk8_b, 'j', body, dim)})"
+            )
+        return result
+
+    lines += body_loop(final_lines, " " * 8)
+    lines.append("    return pos, vel")
+
+    namespace = {"np": np}
+    exec("\n".join(lines), namespace)
+
+    # generated code has no source file, so it cannot be cached on disk
+    return njit(fastmath=True)(namespace["rk8_kernel"])
+
+
+@solver
+def rk8_unrolled(masses, pos, vel, dt, acc):
+    """
+    Solves N body simulation using an eighth-order Runge-Kutta method, see
+    `rk8` function in `integrators`. The integration loop is generated and
+    compiled at runtime specifically for the number of bodies, see
+    `_build_rk8_kernel`. Compiled loops are reused for the same number of
+    bodies within a Python session.
+
+    :param masses: List of N masses.
+    :param pos: Nearly empty list for time evolution of x & y coordinates for N bodies.
+                Only initial conditions should be specified.
+    :param vel: Nearly empty list for time evolution of x & y velocities for N bodies.
+                Only initial conditions should be specified.
+    :param dt: Time step for the simulation.
+    :param acc: See `forward_euler` function above.
+    :return: Time evolution of x & y coordinates for N bodies.
+    """
+
+    n = len(masses)
+    if n not in _rk8_kernels:
+        _rk8_kernels[n] = _build_rk8_kernel(n)
+
+    return _rk8_kernels[n](masses, pos, vel, dt, acc)
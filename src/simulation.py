@@ -4,6 +4,7 @@
 Main file of the simulation. Sets up integration method, initial conditions,
 and time steps. Integrates N body problem and displays animation.
 """
+from argparse import ArgumentParser
 from time import perf_counter
 
 import numpy as np
@@ -20,9 +21,41 @@ __credits__ = ["jeypiti"]
 __license__ = "MIT"
 
 
+def parse_args():
+    """
+    Parses the command line arguments of the simulation. The defaults
+    correspond to the example system set up below.
+
+    :return: Namespace of parsed arguments.
+    """
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--time-steps", type=int, default=1000, help="number of time steps")
+    parser.add_argument("--t-end", type=float, default=10, help="end time of the simulation")
+    parser.add_argument(
+        "--integrator",
+        choices=("forward_euler", "leapfrog", "pefrl", "rk8"),
+        default="pefrl",
+        help="integration method",
+    )
+    parser.add_argument(
+        "--float32",
+        action="store_true",
+        help="integrate in single precision, sufficient for qualitative animations",
+    )
+    parser.add_argument(
+        "--no-animation",
+        action="store_true",
+        help="only run the integration, e.g. for profiling",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    time_steps = 1000
-    t_end = 10
+    args = parse_args()
+
+    time_steps = args.time_steps
+    t_end = args.t_end
     t, dt = np.linspace(0, t_end, num=time_steps, retstep=True)
 
     masses = np.array([0.1, 1, 0.1], dtype=float)
@@ -31,18 +64,31 @@ if __name__ == "__main__":
     pos = np.array([[-5, -1], [0, 0], [1, -5]])
     vel = np.array([[1, 0], [0, 0], [0, 1]])
 
+    # integrators that support it calculate the energy during the integration,
+    # which saves the separate pass over the time evolution in `animate`
+    integrate = getattr(integrators, args.integrator)
+    energy = None
+
     start = perf_counter()
-    pos, vel = integrators.perfl(
+    result = integrate(
         masses,
         pos,
         vel,
         time_steps,
         dt,
         direct_sum.acceleration_vec,
+        dtype=np.float32 if args.float32 else np.float64,
+        track_energy=integrate.tracks_energy,
     )
     end = perf_counter()
     print(
         f"Computation for {len(masses)} bodies and {time_steps:,} time steps took {end - start:,.3f} s"
     )
 
-    animate(masses, pos, vel, t)
+    if integrate.tracks_energy:
+        pos, vel, energy = result
+    else:
+        pos, vel = result
+
+    if not args.no_animation:
+        animate(masses, pos, vel, t, energy=energy)
@@ -3,14 +3,20 @@
 """n-body-sim: src/utils
 File holding various utilities.
 """
-from functools import partial, wraps
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from inspect import signature
+from pathlib import Path
 from time import perf_counter
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
+from matplotlib.animation import FFMpegWriter
 from matplotlib.animation import FuncAnimation as animation
+from matplotlib.animation import PillowWriter
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 
 
 __author__ = "jeypiti"
@@ -28,12 +34,51 @@ def solver(func):
     Decorator for solver functions. Handles basic errors
     and sets up data structures for the simulation.
 
+    The wrapped solver function optionally takes a record_every argument. If
+    given, the state is only recorded every record_every time steps, i.e. at
+    the times times[::record_every], and time steps after the last recorded
+    one are not integrated. The integration then runs on a small buffer of
+    record_every + 1 time steps which stays in the CPU cache, and the memory
+    required for the recorded time evolution shrinks by the same factor.
+
+    The wrapped solver function also optionally takes a dtype argument setting
+    the floating point type of the state. Using np.float32 halves the memory
+    traffic of the integration, which is sufficient for qualitative animations
+    but not for long or precise simulations.
+
+    Solver functions that take a pot_energy argument, i.e. integrators that
+    evaluate the acceleration at the recorded states, can track the energy
+    during the integration. If the wrapped solver function is called with
+    track_energy=True, the acceleration function has to take a pot_out
+    argument as well, e.g. `acceleration_vec` in `direct_sum`. The potential
+    energy is then calculated from the same pairwise distances as the
+    acceleration and the wrapped solver function additionally returns a tuple
+    of kinetic, potential, and total energy over time, see `calculate_energy`.
+    Whether a solver supports this is exposed as its tracks_energy attribute.
+
+    Further keyword arguments of the wrapped solver function are passed on to
+    the solver function, e.g. acc_every of `leapfrog` in `integrators_numba`.
+
     :param func: Solver function.
     :return: Wrapped solver function.
     """
 
+    # compiled solver functions expose the original Python function as py_func
+    tracks_energy = "pot_energy" in signature(getattr(func, "py_func", func)).parameters
+
     @wraps(func)
-    def wrapper(masses, init_pos, init_vel, time_steps, dt, acc_func):
+    def wrapper(
+        masses,
+        init_pos,
+        init_vel,
+        time_steps,
+        dt,
+        acc_func,
+        record_every=1,
+        dtype=np.float64,
+        track_energy=False,
+        **solver_kwargs,
+    ):
 
         if not init_pos.shape[0] == init_vel.shape[0] == len(masses):
             raise ValueError(
@@ -50,25 +95,96 @@ def solver(func):
                 " respectively."
             )
 
+        if record_every < 1:
+            raise ValueError(f"record_every must be at least 1 but is {record_every}.")
+
+        if track_energy and not tracks_energy:
+            raise ValueError(f"{func.__name__} does not support tracking the energy.")
+
         # set up arrays for position and velocity
-        # axis 0 describes the masses
-        # axis 1 describes the coordinates, i.e. 0 -> x, 1 -> y
-        # axis 2 describes the time evolution of the coordinates
-        pos = np.zeros((len(masses), 2, time_steps))
-        vel = np.zeros((len(masses), 2, time_steps))
+        # axis 0 describes the time evolution of the coordinates
+        # axis 1 describes the masses
+        # axis 2 describes the coordinates, i.e. 0 -> x, 1 -> y
+        # such that the state at each time step is a contiguous (N, 2) array
+        records = (time_steps - 1) // record_every + 1
+        pos = np.zeros((records, len(masses), 2), dtype=dtype)
+        vel = np.zeros((records, len(masses), 2), dtype=dtype)
+
+        # masses of the same type avoid mixed precision arithmetic in the acceleration
+        masses = np.asarray(masses, dtype=dtype)
+
+        pos[0] = init_pos
+        vel[0] = init_vel
+
+        # only pass the energy buffer if requested such that solver functions keep the fast path
+        kwargs = {}
+        if track_energy:
+            kwargs["pot_energy"] = np.zeros(records)
+
+        if record_every == 1:
+            func(masses, pos, vel, dt, acc_func, **kwargs, **solver_kwargs)
+            return _with_energy(masses, pos, vel, acc_func, kwargs)
+
+        # integrate in chunks of record_every time steps and only record the last state of each
+        pos_buf = np.zeros((record_every + 1, len(masses), 2), dtype=dtype)
+        vel_buf = np.zeros((record_every + 1, len(masses), 2), dtype=dtype)
+        kwargs_buf = {key: np.zeros(record_every + 1) for key in kwargs}
+
+        for record_idx in range(records - 1):
+            pos_buf[0] = pos[record_idx]
+            vel_buf[0] = vel[record_idx]
 
-        pos[:, :, 0] = init_pos
-        vel[:, :, 0] = init_vel
+            func(masses, pos_buf, vel_buf, dt, acc_func, **kwargs_buf, **solver_kwargs)
 
-        return func(masses, pos, vel, dt, acc_func)
+            pos[record_idx + 1] = pos_buf[-1]
+            vel[record_idx + 1] = vel_buf[-1]
+            for key, buf in kwargs_buf.items():
+                kwargs[key][record_idx] = buf[0]
 
+        return _with_energy(masses, pos, vel, acc_func, kwargs)
+
+    wrapper.tracks_energy = tracks_energy
     return wrapper
 
 
-def animate(masses, pos, vel, times, duration=3, max_frame_rate=60, save_to_path=None):
+def _with_energy(masses, pos, vel, acc_func, kwargs):
+    """
+    Internal function used to assemble the return value of solver functions,
+    see `solver` decorator above. If the potential energy was tracked during
+    the integration, the potential energy of the last recorded state, which
+    solver functions do not evaluate, is calculated and the energies are
+    returned alongside the time evolution.
+
+    :param masses: Array of masses.
+    :param pos: Array of positions over time.
+    :param vel: Array of velocities over time.
+    :param acc_func: Acceleration function used for the integration.
+    :param kwargs: Dictionary of buffers passed to the solver function.
+    :return: Tuple of positions and velocities over time, and optionally
+             a tuple of kinetic, potential, and total energy over time.
+    """
+
+    if "pot_energy" not in kwargs:
+        return pos, vel
+
+    pot_energy = kwargs["pot_energy"]
+    acc_func(masses, pos[-1], out=np.empty_like(pos[-1]), pot_out=pot_energy[-1:])
+
+    # accumulated in double precision like in `calculate_energy` below
+    kin_energy = 0.5 * np.einsum("n,tnd,tnd->t", masses, vel, vel, dtype=np.float64)
+
+    return pos, vel, (kin_energy, pot_energy, kin_energy + pot_energy)
+
+
+# maximum number of points of the static energy curves in `animate`
+max_plot_points = 2000
+
+
+def animate(masses, pos, vel, times, duration=3, max_frame_rate=60, save_to_path=None, energy=None):
     """
     Produces an animation of a given array of positions.
     Optionally saves the animation to a video file if a path is specified.
+    GIF files are written using Pillow, all other formats require ffmpeg.
 
     :param masses: Array of masses.
     :param pos: Array of positions over time.
@@ -78,26 +194,38 @@ def animate(masses, pos, vel, times, duration=3, max_frame_rate=60, save_to_path
     :param max_frame_rate: Maximum frame rate at which the animation
                            should be displayed or saved.
     :param save_to_path: If given, saves the animation to this file path.
+    :param energy: Tuple of kinetic, potential, and total energy over time, e.g.
+                   tracked by the solver. Calculated using `calculate_energy` if not given.
     """
 
     start = perf_counter()
 
-    # initialize figures
-    fig, (ax1, ax2) = plt.subplots(ncols=2, figsize=(13, 5), tight_layout=True)
+    # initialize figures, frames that are only rendered to a file are drawn by a figure
+    # outside of pyplot on the non-interactive Agg canvas, which leaves the backend unchanged
+    if save_to_path:
+        fig = Figure(figsize=(13, 5))
+        FigureCanvasAgg(fig)
+    else:
+        fig = plt.figure(figsize=(13, 5))
+    ax1, ax2 = fig.subplots(ncols=2)
     times = times / times[-1]  # map time to interval [0, 1]
 
-    # prepare a list of artists for animation
-    bodies = [ax1.plot([], [], marker="o")[0] for _ in range(len(masses))]
-    energy_points = [ax2.plot([], [], marker=".")[0] for _ in range(3)]
+    # prepare artists for animation, all bodies and all energy points are each drawn
+    # by a single collection such that a frame only requires one update per collection
+    # colors follow the default color cycle like individual plots would
+    body_colors = [f"C{mass_idx % 10}" for mass_idx in range(len(masses))]
+    bodies = ax1.scatter(np.zeros(len(masses)), np.zeros(len(masses)), c=body_colors, marker="o")
+    energy_points = ax2.scatter(np.zeros(3), np.zeros(3), c=["C0", "C1", "C2"], marker=".")
 
     # appropriately format body figure
     pad = 0.03  # padding of the plot as a percentage of the maximum extent of the simulation
 
-    x_min, x_max = np.min(pos[:, 0, :]), np.max(pos[:, 0, :])
+    # extents of both coordinates at once instead of separate scans over the x & y slices
+    (x_min, y_min), (x_max, y_max) = pos.min(axis=(0, 1)), pos.max(axis=(0, 1))
+
     x_range = x_max - x_min
     ax1.set_xlim(x_min - pad * x_range, x_max + pad * x_range)
 
-    y_min, y_max = np.min(pos[:, 1, :]), np.max(pos[:, 1, :])
     y_range = y_max - y_min
     ax1.set_ylim(y_min - pad * y_range, y_max + pad * y_range)
 
@@ -105,137 +233,201 @@ def animate(masses, pos, vel, times, duration=3, max_frame_rate=60, save_to_path
     ax1.set_ylabel(r"$y\,/\,\mathrm{a.u.}$")
 
     # prepare energy figure
-    kin_energy, pot_energy, tot_energy = calculate_energy(masses, pos, vel)
+    if energy is None:
+        energy = calculate_energy(masses, pos, vel)
+    kin_energy, pot_energy, tot_energy = energy
 
-    plt.gca().set_prop_cycle(None)  # reset color cycle
-    ax2.plot(times, kin_energy, label=r"$E_\mathrm{kin}$")
-    ax2.plot(times, pot_energy, label=r"$E_\mathrm{pot}$")
-    ax2.plot(times, tot_energy, label=r"$E_\mathrm{tot}$")
+    # the static energy curves are redrawn for every frame when saving the animation,
+    # so long simulations are thinned out to roughly the resolution of the figure
+    plot_step = max(1, len(times) // max_plot_points)
+
+    ax2.set_prop_cycle(None)  # reset color cycle
+    ax2.plot(times[::plot_step], kin_energy[::plot_step], label=r"$E_\mathrm{kin}$")
+    ax2.plot(times[::plot_step], pot_energy[::plot_step], label=r"$E_\mathrm{pot}$")
+    ax2.plot(times[::plot_step], tot_energy[::plot_step], label=r"$E_\mathrm{tot}$")
 
     ax2.set_xlim(0, 1)
     ax2.set_xlabel(r"$t\,/\,\mathrm{a.u.}$")
     ax2.set_ylabel(r"$E\,/\,\mathrm{a.u.}$")
     ax2.legend()
 
+    # compute the layout once instead of on every draw, which would happen for every
+    # frame when saving the animation
+    fig.tight_layout()
+
     # calculate animation parameters
-    frame_count = int(min(pos.shape[2], duration * max_frame_rate))
-    frame_step = pos.shape[2] / frame_count
+    frame_count = int(min(pos.shape[0], duration * max_frame_rate))
+    frame_step = pos.shape[0] / frame_count
     frame_rate = frame_count / duration
     frame_time = max(1.0, 1000 / frame_rate)
 
     print(
         f"Rendering {frame_count * frame_time / 1000:.1f}s animation @ {frame_rate:.1f} FPS"
         f" ({frame_time:.1f} ms per frame)\nShowing {frame_count} frames from a total of"
-        f" {pos.shape[2]:,} time steps (one frame every {frame_step:,.1f} steps)"
+        f" {pos.shape[0]:,} time steps (one frame every {frame_step:,.1f} steps)"
     )
 
     # linearly interpolate between time steps to get animation frames
-    anim_pos = np.zeros((len(masses), 2, frame_count))
-    anim_vel = np.zeros((len(masses), 2, frame_count))
-    anim_kin = np.zeros(frame_count)
-    anim_pot = np.zeros(frame_count)
-    anim_tot = np.zeros(frame_count)
-
-    for frame_idx in range(frame_count):
-        time = frame_idx * frame_step
-        lower_idx = int(time)
-        f = time - lower_idx
-
-        anim_pos[:, :, frame_idx] = pos[:, :, lower_idx] * (1 - f) + pos[:, :, lower_idx + 1] * f
-        anim_vel[:, :, frame_idx] = vel[:, :, lower_idx] * (1 - f) + vel[:, :, lower_idx + 1] * f
-        anim_kin[frame_idx] = kin_energy[lower_idx] * (1 - f) + kin_energy[lower_idx + 1] * f
-        anim_pot[frame_idx] = pot_energy[lower_idx] * (1 - f) + pot_energy[lower_idx + 1] * f
-        anim_tot[frame_idx] = tot_energy[lower_idx] * (1 - f) + tot_energy[lower_idx + 1] * f
+    # all frames are interpolated at once by gathering the lower and upper time steps
+    times_f = np.arange(frame_count) * frame_step
+    lower_idx = times_f.astype(np.intp)
+    upper_idx = np.minimum(lower_idx + 1, pos.shape[0] - 1)
+    f = times_f - lower_idx
+    f_state = f[:, np.newaxis, np.newaxis]  # broadcast over bodies and coordinates
+
+    anim_pos = pos[lower_idx] * (1 - f_state) + pos[upper_idx] * f_state
+
+    # (T, 3, 2) array of the positions of the energy points in each frame, such that
+    # get_frame only looks up precomputed frames instead of indexing the full time evolution
+    energies = np.stack(energy, axis=1)
+    anim_energy = np.empty((frame_count, 3, 2))
+    anim_energy[:, :, 0] = (np.arange(frame_count) / frame_count)[:, np.newaxis]
+    anim_energy[:, :, 1] = energies[lower_idx] * (1 - f[:, np.newaxis])
+    anim_energy[:, :, 1] += energies[upper_idx] * f[:, np.newaxis]
 
     def get_frame(frame_idx):
-        # update bodies
-        for mass_idx, body in enumerate(bodies):
-            body.set_data(anim_pos[mass_idx, :, frame_idx])
+        bodies.set_offsets(anim_pos[frame_idx])
+        energy_points.set_offsets(anim_energy[frame_idx])
 
-        # update energy plots
-        for point, energy in zip(energy_points, (anim_kin, anim_pot, anim_tot)):
-            point.set_data(frame_idx / frame_count, energy[frame_idx])
-
-        return bodies + energy_points
-
-    anim = animation(fig, get_frame, frame_count, blit=True, interval=frame_time)
+        return bodies, energy_points
 
     end = perf_counter()
     print(f"Generating the animation took {end - start:.3f} s")
 
     if save_to_path:
+        # stream the frames directly to the writer instead of going through `FuncAnimation`
         start = perf_counter()
-        anim.save(save_to_path)
+        writer_class = PillowWriter if Path(save_to_path).suffix.lower() == ".gif" else FFMpegWriter
+        writer = writer_class(fps=frame_rate)
+        with writer.saving(fig, save_to_path, fig.dpi):
+            # iterate over the precomputed frames directly instead of indexing them per frame
+            for frame_pos, frame_energy in zip(anim_pos, anim_energy):
+                bodies.set_offsets(frame_pos)
+                energy_points.set_offsets(frame_energy)
+                writer.grab_frame()
         end = perf_counter()
         print(f"Render took {end - start:.3f} s")
     else:
+        # keep a reference to the animation, otherwise it is garbage collected
+        anim = animation(fig, get_frame, frame_count, blit=True, interval=frame_time)
         plt.show()
 
 
-def _get_energy_at_time(masses, pos, vel, time_idx):
+def _potential_energy(masses, pos, pot_energy, steps_per_block):
     """
-    Internal function used to calculate kinetic energy and potential energy at
-    a give time index using a vectorized direct sum approach. This function is
-    necessary to facilitate the parallelization of the energy calculation
-    across multiple CPU cores.
+    Internal function used to calculate the potential energy for each time
+    step using a vectorized direct sum approach. The time steps are
+    processed in blocks of steps_per_block time steps at once.
 
     :param masses: Array of masses.
     :param pos: Array of positions over time.
-    :param vel: Array of velocities over time.
-    :param time_idx: Time index at which the energy is to be calculated.
-    :return: Tuple of kinetic energy and potential energy
-             at the give time index.
+    :param pot_energy: Array the potential energy over time is written to. Its type may
+                       be wider than the type of the positions.
+    :param steps_per_block: Number of time steps per block.
     """
 
-    # kinetic energy
-    kin_energy = 0.5 * np.sum(masses * np.sum(vel[:, :, time_idx] ** 2, axis=1))
+    time_steps, n = pos.shape[:2]
+    steps_per_block = min(time_steps, steps_per_block)
 
-    # potential energy
-    # extract x & y coordinates to a (N, 1) array
-    x = pos[:, 0:1, time_idx]
-    y = pos[:, 1:2, time_idx]
+    # quantities that are the same for all time steps
+    # each pair of bodies i < j is only considered once, given by the indices of both
+    # bodies together with the product of their masses
+    pair_i, pair_j = np.triu_indices(n, 1)
+    pair_masses = masses[pair_i].astype(np.float64) * masses[pair_j]
 
-    # matrices that store pairwise body distances
-    dx = x.T - x
-    dy = y.T - y
+    # buffers for the positions of both bodies of each pair and the distances of the pairs,
+    # reused for all blocks, using the type of the positions such that float32 simulations
+    # stay float32, which is only accurate because the differences are taken before squaring
+    pos_i_buf = np.empty((steps_per_block, len(pair_i), 2), dtype=pos.dtype)
+    pos_j_buf = np.empty((steps_per_block, len(pair_i), 2), dtype=pos.dtype)
+    pair_buf = np.empty((steps_per_block, len(pair_i)), dtype=pos.dtype)
 
-    # calculate pairwise inverse norm of distances
-    # mask operation to avoid divide by zero
-    norm = np.sqrt(dx ** 2 + dy ** 2)
-    inv = np.zeros_like(norm)  # ensure that diagonal of inv will only contain zeros
-    np.divide(1, norm, where=norm != 0, out=inv)
+    for start in range(0, time_steps, steps_per_block):
+        end = min(start + steps_per_block, time_steps)
+        block_pos = pos[start:end]
 
-    # multiply matrix element ij with the masses of bodies i and j
-    energy_per_body = np.transpose(inv * masses) * masses
+        # gather both bodies of each pair and take the differences before squaring, such that
+        # close pairs far from the origin do not lose their precision
+        diff = np.take(block_pos, pair_i, axis=1, out=pos_i_buf[: end - start])
+        diff -= np.take(block_pos, pair_j, axis=1, out=pos_j_buf[: end - start])
 
-    # sum energies
-    pot_energy = -0.5 * energy_per_body.sum()
+        # calculate inverse norm of distances only for the pairs, which halves the number of
+        # square roots compared to the full matrix and avoids the zero distances on the diagonal
+        inv = np.einsum("tpd,tpd->tp", diff, diff, out=pair_buf[: end - start])
+        np.sqrt(inv, out=inv)
+        np.reciprocal(inv, out=inv)
 
-    return kin_energy, pot_energy
+        # sum energies, the float64 pair masses make the sum accumulate in double precision
+        pot_energy[start:end] = -(inv @ pair_masses)
 
 
-def calculate_energy(masses, pos, vel):
+def calculate_energy(masses, pos, vel, block_size=2 ** 16, threads=None):
     """
     Calculates kinetic energy, gravitational potential energy, and
     total energy for the whole system for each time step in the simulation.
 
+    The potential energy is calculated for many time steps at once using a
+    vectorized direct sum approach. To limit the memory usage, the time steps
+    are processed in blocks such that each block contains at most block_size
+    pairwise distances. If block_size is None, all time steps are processed
+    in a single block, which minimizes the number of NumPy calls at the cost
+    of memory proportional to the number of time steps.
+
+    A compiled version of this function is available as `energy` in
+    `direct_sum_numba`, which is considerably faster for large systems.
+
+    For large systems, the time steps can be distributed across multiple
+    threads. The threads share the positions and write the potential energy
+    directly into the result, so no data has to be copied between workers.
+
     :param masses: Array of masses.
     :param pos: Array of positions over time.
     :param vel: Array of velocities over time.
+    :param block_size: Maximum number of pairwise distances per block or None.
+    :param threads: If given, number of threads used to calculate the potential energy.
     :return: Tuple of kinetic energy over time, potential
              energy over time, and total energy over time.
     """
 
-    with Pool() as pool:
-        # distribute calculations across all CPU threads
-        result = pool.map(
-            partial(_get_energy_at_time, masses, pos, vel),
-            range(pos.shape[2]),
-        )
-
-    # convert result to NumPy array and extract kinetic and potential energy
-    result = np.array(result)
-    kin_energy = result[:, 0]
-    pot_energy = result[:, 1]
+    time_steps, n = pos.shape[:2]
+    if block_size is None:
+        steps_per_block = time_steps
+    else:
+        steps_per_block = max(1, block_size // n ** 2)
+
+    # kinetic energy, accumulated in double precision even for float32 simulations like in
+    # the compiled kernels
+    kin_energy = 0.5 * np.einsum("n,tnd,tnd->t", masses, vel, vel, dtype=np.float64)
+
+    if threads is not None and threads < 1:
+        raise ValueError(f"threads must be at least 1 but is {threads}.")
+
+    # potential energy, a single thread runs the vectorized blocks directly without a pool
+    if threads is None or threads == 1:
+        pot_energy = np.empty(time_steps)
+        _potential_energy(masses, pos, pot_energy, steps_per_block)
+        return kin_energy, pot_energy, kin_energy + pot_energy
+
+    # split the time steps into a few chunks per thread to balance the load
+    chunk_size = -(-time_steps // (4 * threads))
+
+    # NumPy releases the GIL for the array operations, so threads run in parallel while
+    # writing directly into disjoint slices of the same array
+    pot_energy = np.empty(time_steps)
+    with ThreadPoolExecutor(threads) as executor:
+        futures = [
+            executor.submit(
+                _potential_energy,
+                masses,
+                pos[start : start + chunk_size],
+                pot_energy[start : start + chunk_size],
+                steps_per_block,
+            )
+            for start in range(0, time_steps, chunk_size)
+        ]
+
+        # propagate exceptions raised in the threads
+        for future in futures:
+            future.result()
 
     return kin_energy, pot_energy, kin_energy + pot_energy